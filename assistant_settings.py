@@ -1,12 +1,13 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 class PromptMode(Enum):
     panel = "panel"
     append = "append"
     insert = "insert"
     replace = "replace"
+    inline = "inline"
 
 @dataclass
 class AssistantSettings():
@@ -20,9 +21,33 @@ class AssistantSettings():
     frequency_penalty: int
     presence_penalty: int
     placeholder: Optional[str] = None
+    # Ordered candidates to route a request to by its size, `chat_model` is used if it's empty.
+    models: Optional[List[Dict[str, Any]]] = None
+    # API endpoint overrides, the global settings are used for those left empty.
+    provider: Optional[str] = None
+    url: Optional[str] = None
+    token: Optional[str] = None
+    api_path: Optional[str] = None
+    auth_scheme: Optional[str] = None
+    # Client side stop conditions for `append`, `insert` and `replace` streams.
+    stop_at_code_block_end: bool = False
+    stop_patterns: Optional[List[str]] = None
+    max_lines: Optional[int] = None
+    # Overrides of the global `timeouts` in seconds, by the same keys.
+    timeouts: Optional[Dict[str, float]] = None
 
 DEFAULT_ASSISTANT_SETTINGS = {
     "placeholder": None,
+    "models": None,
+    "provider": None,
+    "url": None,
+    "token": None,
+    "api_path": None,
+    "auth_scheme": None,
+    "stop_at_code_block_end": False,
+    "stop_patterns": None,
+    "max_lines": None,
+    "timeouts": None,
     "temperature": 1,
     "max_tokens": 2048,
     "top_p": 1,
@@ -34,4 +59,5 @@ class CommandMode(Enum):
     refresh_output_panel = "refresh_output_panel"
     create_new_tab = "create_new_tab"
     reset_chat_history = "reset_chat_history"
+    restore_archived_history = "restore_archived_history"
     chat_completion = "chat_completion"
@@ -0,0 +1,437 @@
+import difflib
+import fnmatch
+import functools
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from enum import Enum
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Set, Tuple
+
+import sublime
+from sublime import Window
+from sublime_plugin import WindowCommand
+
+from . import jl_utility as jl
+from .assistant_settings import AssistantSettings, DEFAULT_ASSISTANT_SETTINGS, PromptMode
+from .cacher import Cacher
+from .errors.OpenAIException import ConnectTimeoutException, FirstByteTimeoutException
+from .openai_network_client import NetworkClient, sse_deltas
+from .stream_guard import StreamStopDetector, strip_code_fence
+
+
+class BatchOutput(Enum):
+    in_place = "in_place"
+    results_dir = "results_dir"
+    diff = "diff"
+
+
+@dataclass
+class BatchJob():
+    job_id: str
+    file: str
+    chunk_index: int
+    text: str
+    # Chunks that don't need a request at all (e.g. `insert` without a placeholder) pass through as is.
+    passthrough: bool = False
+
+
+def matches_any(name: str, patterns: List[str]) -> bool:
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def is_excluded(relative_path: str, folder_excludes: List[str], file_excludes: List[str]) -> bool:
+    *folders, name = relative_path.split(os.sep)
+    return (
+        any(folder.startswith('.') or matches_any(folder, folder_excludes) for folder in folders)
+        or matches_any(name, file_excludes)
+    )
+
+
+class BatchJournal():
+    """Persisted log of finished jobs. Once an interrupted batch runs again, it skips them.
+
+    Jobs are identified by a hash of an assistant setup, instruction and a chunk text,
+    so an unchanged chunk is never sent twice, unless a batch is run with `rerun`.
+    Only job ids are kept in the journal (and in memory), each output is a separate file,
+    and the oldest jobs are forgotten once there're more than `CAPACITY` of them.
+    """
+    CAPACITY = 10000
+
+    def __init__(self, cacher: Cacher) -> None:
+        self.journal_file = cacher.batch_journal_file
+        self.outputs_dir = cacher.batch_outputs_dir
+        self.lock = Lock()
+        cacher.check_and_create(self.journal_file)
+        os.makedirs(self.outputs_dir, exist_ok=True)
+
+        records: List[Dict] = []
+        intact = True
+        with open(self.journal_file, 'r', encoding='utf-8', errors='replace') as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A line torn by an interrupted run, the job is simply done again.
+                    intact = False
+                    continue
+                intact = intact and line.endswith('\n')
+
+        # Records are unique by job, the latest one wins and goes last.
+        latest: Dict[str, Dict] = {}
+        for record in records:
+            if record.get('status') != 'done': continue
+            if 'output' in record:
+                # Journals of earlier versions kept outputs inline.
+                with open(self.output_path(record['job']), 'w', encoding='utf-8') as file:
+                    file.write(record.pop('output'))
+                intact = False
+            latest.pop(record['job'], None)
+            latest[record['job']] = record
+        records = [record for record in latest.values() if self.has_output(record['job'])]
+        if len(records) > self.CAPACITY:
+            for record in records[:-self.CAPACITY]:
+                os.remove(self.output_path(record['job']))
+            records = records[-self.CAPACITY:]
+            intact = False
+        if not intact:
+            self.rewrite(records)
+        self.done: Set[str] = {record['job'] for record in records}
+
+    def output_path(self, job_id: str) -> str:
+        return os.path.join(self.outputs_dir, job_id)
+
+    def has_output(self, job_id: str) -> bool:
+        return os.path.isfile(self.output_path(job_id))
+
+    def output(self, job_id: str) -> str:
+        with open(self.output_path(job_id), 'r', encoding='utf-8') as file:
+            return file.read()
+
+    def rewrite(self, records: List[Dict]):
+        writer = jl.writer(self.journal_file, mode='w')
+        next(writer)
+        for record in records:
+            writer.send(record)
+        writer.close()
+
+    def record(self, job: BatchJob, output: str):
+        with self.lock:
+            # The output goes first, so a journal record never points to a missing one.
+            with open(self.output_path(job.job_id), 'w', encoding='utf-8') as file:
+                file.write(output)
+            self.done.add(job.job_id)
+            writer = jl.writer(self.journal_file)
+            next(writer)
+            writer.send({'job': job.job_id, 'file': job.file, 'chunk': job.chunk_index, 'status': 'done'})
+            writer.close()
+
+
+class BatchRunner(Thread):
+    def __init__(
+        self,
+        window: Window,
+        stop_event: Event,
+        assistant: AssistantSettings,
+        files: List[str],
+        instruction: Optional[str],
+        output: BatchOutput,
+        rerun: bool = False,
+    ) -> None:
+        self.window = window
+        # Sends every job again, ignoring the outputs recorded by the journal.
+        self.rerun = rerun
+        self.stop_event = stop_event
+        self.assistant = assistant
+        self.files = files
+        self.instruction = instruction
+        self.settings = sublime.load_settings("openAI.sublime-settings")
+        self.output = BatchOutput.results_dir if output == BatchOutput.in_place and assistant.prompt_mode == PromptMode.panel.value else output
+        self.cacher = Cacher()
+        # Loaded within the runner thread, since it reads (and could repair) the journal file.
+        self.journal: Optional[BatchJournal] = None
+        self.results_dir = self.settings.get('batch_results_dir') or os.path.join(self.cacher.batch_results_dir, time.strftime('%Y%m%d-%H%M%S'))
+        super(BatchRunner, self).__init__()
+
+    def create_jobs(self, file: str, text: str) -> List[BatchJob]:
+        chunk_lines = self.settings.get('batch_chunk_lines', 0)
+        lines = text.splitlines(keepends=True)
+        chunks = [''.join(lines[index:index + chunk_lines]) for index in range(0, len(lines), chunk_lines)] if chunk_lines > 0 else [text]
+
+        jobs = []
+        for chunk_index, chunk in enumerate(chunks):
+            job_key = '\0'.join([self.assistant.chat_model, self.assistant.assistant_role, self.assistant.prompt_mode, self.instruction or '', chunk])
+            passthrough = self.assistant.prompt_mode == PromptMode.insert.value and (not self.assistant.placeholder or self.assistant.placeholder not in chunk)
+            jobs.append(BatchJob(
+                job_id=hashlib.sha1(job_key.encode('utf-8')).hexdigest(),
+                file=file,
+                chunk_index=chunk_index,
+                text=chunk,
+                passthrough=passthrough or not chunk.strip()
+            ))
+        return jobs
+
+    def create_messages(self, job: BatchJob) -> List[Dict[str, str]]:
+        extension = os.path.splitext(job.file)[1].lstrip('.')
+        messages = []
+        if self.assistant.placeholder: messages.append({"role": "system", "content": f'placeholder: {self.assistant.placeholder}', 'name': 'OpenAI_completion'})
+        messages.append({"role": "user", "content": f"```{extension}\n" + job.text + "\n```", 'name': 'OpenAI_completion'})
+        if self.instruction: messages.append({"role": "user", "content": self.instruction, 'name': 'OpenAI_completion'})
+        return messages
+
+    def run_job(self, job: BatchJob) -> Optional[str]:
+        if self.stop_event.is_set(): return None
+
+        retries_left = self.settings.get('timeout_retries', 1)
+        while True:
+            provider = NetworkClient(settings=self.settings, assistant=self.assistant)
+            payload = provider.prepare_payload(assitant_setting=self.assistant, messages=self.create_messages(job), with_history=False)
+            try:
+                provider.prepare_request(json_payload=payload)
+                response = provider.execute_response()
+                break
+            except (ConnectTimeoutException, FirstByteTimeoutException):
+                # Nothing has been received yet, so the job is sent again by a new connection.
+                if retries_left <= 0 or self.stop_event.is_set(): raise
+                retries_left -= 1
+
+        stop_detector = StreamStopDetector.from_assistant(self.assistant)
+        guarded = stop_detector.enabled and self.assistant.prompt_mode != PromptMode.panel.value
+        completion: List[str] = []
+        try:
+            for delta in sse_deltas(provider.iterate_response(response)):
+                if self.stop_event.is_set(): return None
+                content = delta.get('content') or ''
+                completion.append(stop_detector.feed(content) if guarded else content)
+                if stop_detector.stopped: break
+        finally:
+            provider.close_connection()
+        if guarded:
+            completion.append(stop_detector.flush())
+        return ''.join(completion)
+
+    def apply_completion(self, job: BatchJob, completion: str) -> str:
+        if job.passthrough: return job.text
+        if self.assistant.prompt_mode == PromptMode.append.value:
+            result = job.text + "\n" + completion
+        elif self.assistant.prompt_mode == PromptMode.insert.value:
+            result = job.text.replace(self.assistant.placeholder, strip_code_fence(completion), 1)
+        elif self.assistant.prompt_mode == PromptMode.replace.value:
+            result = strip_code_fence(completion)
+        else:
+            result = completion
+        # Answers rarely end with a line break, while chunks are joined back as is.
+        if job.text.endswith('\n') and not result.endswith('\n'):
+            result += '\n'
+        return result
+
+    def result_path(self, file: str) -> str:
+        folder = next((folder for folder in self.window.folders() if file.startswith(folder + os.sep)), None)
+        relative_path = os.path.relpath(file, folder) if folder else os.path.basename(file)
+        suffix = '.md' if self.assistant.prompt_mode == PromptMode.panel.value else ''
+        return os.path.join(self.results_dir, relative_path + suffix)
+
+    def write_result(self, file: str, original: str, result: str) -> Optional[str]:
+        if self.output == BatchOutput.diff and self.assistant.prompt_mode != PromptMode.panel.value:
+            return ''.join(difflib.unified_diff(
+                original.splitlines(keepends=True),
+                result.splitlines(keepends=True),
+                fromfile=file,
+                tofile=file
+            ))
+
+        path = file if self.output == BatchOutput.in_place else self.result_path(file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as output_file:
+            output_file.write(result)
+        return None
+
+    def update_progress(self, done: int, total: int):
+        sublime.set_timeout(lambda: self.window.status_message(f"OpenAI batch: {done}/{total} jobs done"), 0)
+
+    def run(self):
+        self.journal = BatchJournal(cacher=self.cacher)
+        originals: Dict[str, str] = {}
+        jobs: List[BatchJob] = []
+        failures: List[Tuple[str, str]] = []
+        for file in self.files:
+            try:
+                with open(file, 'r', encoding='utf-8') as input_file:
+                    originals[file] = input_file.read()
+            except (OSError, UnicodeDecodeError) as error:
+                failures.append((file, str(error)))
+                continue
+            jobs += self.create_jobs(file=file, text=originals[file])
+
+        pending = [job for job in jobs if not job.passthrough and (self.rerun or job.job_id not in self.journal.done)]
+        done_count = len(jobs) - len(pending)
+        self.update_progress(done_count, len(jobs))
+
+        remaining_per_file: Dict[str, int] = {}
+        for job in pending:
+            remaining_per_file[job.file] = remaining_per_file.get(job.file, 0) + 1
+
+        diffs: List[str] = []
+        written: List[str] = []
+
+        def complete_file(file: str):
+            file_jobs = sorted((job for job in jobs if job.file == file), key=lambda job: job.chunk_index)
+            result = ''.join(self.apply_completion(job, self.journal.output(job.job_id) if job.job_id in self.journal.done else '') for job in file_jobs)
+            diff = self.write_result(file=file, original=originals[file], result=result)
+            if diff: diffs.append(diff)
+            written.append(file)
+
+        # Files which jobs have been all done already within a previous run.
+        for file in originals:
+            if file not in remaining_per_file:
+                complete_file(file)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.settings.get('batch_concurrency', 4))) as pool:
+            futures: Dict[Future, BatchJob] = {pool.submit(self.run_job, job): job for job in pending}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    completion = future.result()
+                except Exception as error:
+                    failures.append((job.file, f"chunk {job.chunk_index}: {error}"))
+                    continue
+
+                if completion is None:
+                    # Stopped by a user, the rest of the jobs are left for the next run.
+                    for rest in futures: rest.cancel()
+                    continue
+
+                self.journal.record(job=job, output=completion)
+                done_count += 1
+                self.update_progress(done_count, len(jobs))
+
+                remaining_per_file[job.file] -= 1
+                if remaining_per_file[job.file] == 0:
+                    complete_file(job.file)
+
+        sublime.set_timeout(functools.partial(self.present_summary, len(jobs), done_count, written, diffs, failures), 0)
+
+    def present_summary(self, total: int, done: int, written: List[str], diffs: List[str], failures: List[Tuple[str, str]]):
+        view = self.window.new_file()
+        view.set_scratch(True)
+        view.set_name("OpenAI: Batch Results")
+
+        summary = [f"# {self.assistant.name}: {done}/{total} jobs done, {len(written)} files completed"]
+        if self.stop_event.is_set():
+            summary.append("# Stopped, run the same batch again to resume it")
+        if self.output != BatchOutput.diff or self.assistant.prompt_mode == PromptMode.panel.value:
+            summary.append(f"# Output: {'files are changed in place' if self.output == BatchOutput.in_place else self.results_dir}")
+        summary += [f"# Failed {file}: {error}" for file, error in failures]
+
+        if diffs:
+            view.set_syntax_file("Packages/Diff/Diff.sublime-syntax")
+        view.run_command('append', {'characters': '\n'.join(summary) + '\n\n' + ''.join(diffs)})
+        view.set_read_only(True)
+
+
+class OpenaiBatchCommand(WindowCommand):
+    """Runs a single assistant over many files at once.
+
+    Files come either from `paths` (e.g. selected within the side bar) or from glob patterns
+    relative to the window folders, each file (or each `batch_chunk_lines` chunk of it) is a separate job.
+    """
+    stop_event: Event = Event()
+    runner: Optional[BatchRunner] = None
+
+    def run(self, paths: Optional[List[str]] = None, assistant: Optional[str] = None, instruction: Optional[str] = None, output: Optional[str] = None, rerun: bool = False):
+        settings = sublime.load_settings("openAI.sublime-settings")
+        assistants = [
+            AssistantSettings(**{**DEFAULT_ASSISTANT_SETTINGS, **assistant_dict})
+            for assistant_dict in settings.get('assistants', [])
+        ]
+        batch_output = BatchOutput(output or settings.get('batch_output', BatchOutput.diff.value))
+
+        proceed = functools.partial(self.on_assistant, paths, instruction, batch_output, rerun, assistants)
+        selected = next((index for index, item in enumerate(assistants) if item.name == assistant), None)
+        if selected is not None:
+            proceed(selected)
+        else:
+            self.window.show_quick_panel([f"{item.name} | {item.prompt_mode} | {item.chat_model}" for item in assistants], proceed)
+
+    def on_assistant(self, paths: Optional[List[str]], instruction: Optional[str], output: BatchOutput, rerun: bool, assistants: List[AssistantSettings], index: int):
+        if index == -1: return
+        proceed = functools.partial(self.on_files, instruction, output, rerun, assistants[index])
+        if paths:
+            proceed(self.collect_files(paths=paths, patterns=[]))
+        else:
+            self.window.show_input_panel(
+                "Files (glob patterns): ",
+                "**/*.py",
+                lambda patterns: proceed(self.collect_files(paths=[], patterns=patterns.split())),
+                None,
+                None
+            )
+
+    def on_files(self, instruction: Optional[str], output: BatchOutput, rerun: bool, assistant: AssistantSettings, files: List[str]):
+        if not files:
+            self.window.status_message("OpenAI batch: no files matched")
+            return
+        if instruction is not None:
+            self.start(assistant=assistant, files=files, instruction=instruction, output=output, rerun=rerun)
+            return
+        self.window.show_input_panel(
+            f"Instruction for {len(files)} files: ",
+            "",
+            lambda text: self.start(assistant=assistant, files=files, instruction=text, output=output, rerun=rerun),
+            None,
+            None
+        )
+
+    def collect_files(self, paths: List[str], patterns: List[str]) -> List[str]:
+        folder_excludes, file_excludes = self.exclude_patterns()
+        files: List[str] = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, folders, names in os.walk(path):
+                    # Pruned in place, so hidden (e.g. `.git`) and excluded folders aren't walked into at all.
+                    folders[:] = [folder for folder in folders if not folder.startswith('.') and not matches_any(folder, folder_excludes)]
+                    files += [os.path.join(root, name) for name in sorted(names) if not matches_any(name, file_excludes)]
+            elif os.path.isfile(path):
+                files.append(path)
+        for folder in self.window.folders():
+            for pattern in patterns:
+                files += [
+                    file for file in glob.glob(os.path.join(folder, pattern), recursive=True)
+                    if os.path.isfile(file) and not is_excluded(os.path.relpath(file, folder), folder_excludes, file_excludes)
+                ]
+        return list(dict.fromkeys(files))
+
+    def exclude_patterns(self) -> Tuple[List[str], List[str]]:
+        """`folder_exclude_patterns` and `file_exclude_patterns` of the user preferences and of the project folders."""
+        preferences = sublime.load_settings("Preferences.sublime-settings")
+        folder_excludes = list(preferences.get('folder_exclude_patterns', []))
+        file_excludes = list(preferences.get('file_exclude_patterns', []))
+        for folder in (self.window.project_data() or {}).get('folders', []):
+            folder_excludes += folder.get('folder_exclude_patterns', [])
+            file_excludes += folder.get('file_exclude_patterns', [])
+        return folder_excludes, file_excludes
+
+    def start(self, assistant: AssistantSettings, files: List[str], instruction: str, output: BatchOutput, rerun: bool = False):
+        OpenaiBatchCommand.stop_worker()
+        # A fresh event per batch, so a stopped batch keeps its signal while winding down.
+        OpenaiBatchCommand.stop_event = Event()
+        OpenaiBatchCommand.runner = BatchRunner(
+            window=self.window,
+            stop_event=OpenaiBatchCommand.stop_event,
+            assistant=assistant,
+            files=files,
+            instruction=instruction or None,
+            output=output,
+            rerun=rerun
+        )
+        OpenaiBatchCommand.runner.start()
+
+    @classmethod
+    def stop_worker(cls):
+        if cls.runner and cls.runner.is_alive():
+            cls.stop_event.set()
+            cls.runner = None
@@ -1,12 +1,24 @@
 import sublime
 import os
+import gzip
+import hashlib
+import locale
+import shutil
 from . import jl_utility as jl
+from .history_index import HistoryIndex
 import json
 from json.decoder import JSONDecodeError
-from typing import List, Dict, Iterator, Any, Optional
+from typing import List, Dict, Iterator, Any, Optional, Set
+
+
+def content_digest(content: str) -> str:
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
 
 
 class Cacher():
+    # History files that are known to be UTF-8 already, they're checked once per session.
+    utf8_histories: Set[str] = set()
+
     def __init__(self, name: str = '') -> None:
         cache_dir = sublime.cache_path()
         plugin_cache_dir = os.path.join(cache_dir, 'OpenAI completion')
@@ -16,6 +28,18 @@ class Cacher():
         # Create the file path to store the data
         self.history_file = os.path.join(plugin_cache_dir, f"{name}chat_history.jl")
         self.current_model_file = os.path.join(plugin_cache_dir, f"{name}current_assistant.json")
+        self.archive_dir = os.path.join(plugin_cache_dir, f"{name}chat_history_archive")
+        # Exists while restored messages are in the active history, archiving is suspended until it's reset.
+        self.restored_marker_file = os.path.join(plugin_cache_dir, f"{name}chat_history_restored")
+        self.batch_journal_file = os.path.join(plugin_cache_dir, f"{name}batch_journal.jl")
+        self.batch_outputs_dir = os.path.join(plugin_cache_dir, f"{name}batch_outputs")
+        self.batch_results_dir = os.path.join(plugin_cache_dir, f"{name}batch_results")
+        self.metrics_file = os.path.join(plugin_cache_dir, f"{name}metrics.jl")
+        self.profiles_dir = os.path.join(plugin_cache_dir, f"{name}profiles")
+        self.content_digests_file = os.path.join(plugin_cache_dir, f"{name}content_digests.json")
+        # Originals of deduplicated selections by a digest of the reference that stands for them in the history.
+        self.selection_references_file = os.path.join(plugin_cache_dir, f"{name}selection_references.json")
+        self.history_index = HistoryIndex(os.path.join(plugin_cache_dir, f"{name}history_index.json"))
 
     def check_and_create(self, path: str):
         if not os.path.isfile(path):
@@ -37,7 +61,7 @@ class Cacher():
         return data
 
     def read_all(self) -> List[Dict[str, str]]:
-        self.check_and_create(self.history_file)
+        self.__prepare_history__()
         json_objects: List[Dict[str, str]] = []
         reader: Iterator[Dict[str, str]] = jl.reader(self.history_file)
         for json_object in reader:
@@ -45,8 +69,14 @@ class Cacher():
 
         return json_objects
 
+    def read_all_raw(self) -> List[bytes]:
+        """Returns history messages as they're stored, i.e. serialized json objects, without parsing them."""
+        self.__prepare_history__()
+        with open(self.history_file, 'rb') as file:
+            return [line.rstrip(b'\n') for line in file if line.strip()]
+
     def read_last(self, number: int) -> List[Dict[str, str]]:
-        self.check_and_create(self.history_file)
+        self.__prepare_history__()
         json_objects: List[Dict[str, str]] = []
 
         # Read the entire file and split into lines
@@ -69,25 +99,220 @@ class Cacher():
         return json_objects
 
     def append_to_cache(self, cache_lines):
+        self.__prepare_history__()
         # Create a new JSON Lines writer for output.jl
         writer = jl.writer(self.history_file)
         next(writer)
         for line in cache_lines:
             writer.send(line)
+        writer.close()
+        self.history_index.add_active(cache_lines)
+
+        if os.path.isfile(self.content_digests_file):
+            self.__save_content_digests__(self.content_digests() | {content_digest(line['content']) for line in cache_lines if line['role'] == 'user'})
 
     def drop_first(self, number = 4):
-        self.check_and_create(self.history_file)
+        self.__prepare_history__()
         # Read all lines from the JSON Lines file
-        with open(self.history_file, 'r') as file:
+        with open(self.history_file, 'rb') as file:
             lines = file.readlines()
 
         # Remove the specified number of lines from the beginning
-        lines = lines[number:]
+        lines = self.__rehydrate_references__(lines[number:])
 
         # Write the remaining lines back to the cache file
-        with open(self.history_file, 'w') as file:
+        with open(self.history_file, 'wb') as file:
             file.writelines(lines)
+        self.history_index.invalidate()
+        self.__drop_content_digests__()
 
     def drop_all(self):
         with open(self.history_file, 'w') as _:
             pass # Truncate the file by opening it in 'w' mode and doing nothing
+        for path in (self.restored_marker_file, self.selection_references_file):
+            if os.path.isfile(path):
+                os.remove(path)
+        self.history_index.invalidate()
+        self.__drop_content_digests__()
+
+    def archive_overflow(self, retention: int, segment_size_kb: int = 512):
+        """Moves the oldest messages beyond `retention` into gzip compressed archive segments.
+
+        The split point is moved forward to the beginning of the next question,
+        so a question and its answer never end up in different files.
+        Nothing is archived once a segment has been restored, otherwise the next answer would move it right back.
+        """
+        if os.path.isfile(self.restored_marker_file):
+            return
+        self.__prepare_history__()
+        with open(self.history_file, 'rb') as file:
+            lines = file.readlines()
+
+        split = len(lines) - retention
+        if retention <= 0 or split <= 0:
+            return
+
+        while split < len(lines) and not self.__starts_exchange__(lines[split - 1], lines[split]):
+            split += 1
+        if split >= len(lines):
+            return
+
+        segment = self.__current_segment__(segment_size_kb=segment_size_kb)
+        with gzip.open(segment, 'ab') as archive:
+            archive.writelines(lines[:split])
+
+        # Writing a remaining lines into a temporary file first, so an interruption wouldn't wipe the history.
+        temp_file = f"{self.history_file}.tmp"
+        remaining = self.__rehydrate_references__(lines[split:])
+        with open(temp_file, 'wb') as file:
+            file.writelines(remaining)
+        os.replace(temp_file, self.history_file)
+        if remaining == lines[split:]:
+            self.history_index.archive(number=split, segment=os.path.basename(segment))
+        else:
+            # Rehydrated messages have a different text to be indexed.
+            self.history_index.invalidate()
+        self.__drop_content_digests__()
+
+    def archive_segments(self) -> List[str]:
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return [
+            os.path.join(self.archive_dir, file_name)
+            for file_name in sorted(os.listdir(self.archive_dir))
+            if file_name.endswith('.jl.gz')
+        ]
+
+    def read_segment(self, segment: str) -> Iterator[Dict[str, str]]:
+        return jl.compressed_reader(segment)
+
+    def read_archive(self) -> Iterator[Dict[str, str]]:
+        for segment in self.archive_segments():
+            yield from self.read_segment(segment)
+
+    def restore_segment(self, segment: str):
+        """Moves archived messages back in front of the active history, streaming them chunk by chunk.
+
+        Every segment newer than the given one is restored as well to keep the history in chronological order.
+        """
+        self.__prepare_history__()
+        segments = self.archive_segments()
+        segments = segments[segments.index(segment):]
+
+        temp_file = f"{self.history_file}.tmp"
+        with open(temp_file, 'wb') as output:
+            for path in segments:
+                with gzip.open(path, 'rb') as archive:
+                    shutil.copyfileobj(archive, output)
+            with open(self.history_file, 'rb') as active:
+                shutil.copyfileobj(active, output)
+        os.replace(temp_file, self.history_file)
+
+        for path in segments:
+            os.remove(path)
+        self.check_and_create(self.restored_marker_file)
+        self.history_index.invalidate()
+        self.__drop_content_digests__()
+
+    def rebuild_history_index(self):
+        self.__prepare_history__()
+        self.history_index.rebuild(
+            active=jl.reader(self.history_file),
+            archive=((os.path.basename(segment), self.read_segment(segment)) for segment in self.archive_segments())
+        )
+
+    def content_digests(self) -> Set[str]:
+        """Digests of user messages within the active history, kept aside to avoid reading the history itself."""
+        if os.path.isfile(self.content_digests_file):
+            with open(self.content_digests_file, 'r') as file:
+                try:
+                    return set(json.load(file))
+                except JSONDecodeError:
+                    pass
+
+        digests = {content_digest(line['content']) for line in self.read_all() if line['role'] == 'user'}
+        self.__save_content_digests__(digests)
+        return digests
+
+    def remember_reference(self, reference: str, original: str):
+        """Keeps an original of a deduplicated selection, so it could be brought back once it leaves the active history."""
+        references = self.__selection_references__()
+        references[content_digest(reference)] = original
+        with open(self.selection_references_file, 'w', encoding='utf-8') as file:
+            json.dump(references, file, ensure_ascii=False)
+
+    def __selection_references__(self) -> Dict[str, str]:
+        if not os.path.isfile(self.selection_references_file):
+            return {}
+        with open(self.selection_references_file, 'r', encoding='utf-8') as file:
+            try:
+                return json.load(file)
+            except JSONDecodeError:
+                return {}
+
+    def __rehydrate_references__(self, lines: List[bytes]) -> List[bytes]:
+        """Puts an original selection back in place of the first reference to it, once the original itself is gone.
+
+        Later references keep pointing to that one, and lines that don't need it are kept byte to byte as they are.
+        """
+        references = self.__selection_references__()
+        if not references: return lines
+
+        present: Set[str] = set()
+        result: List[bytes] = []
+        for line in lines:
+            message = json.loads(line) if line.strip() else None
+            if message and message['role'] == 'user':
+                original = references.get(content_digest(message['content']))
+                if original is not None and content_digest(original) not in present:
+                    message['content'] = original
+                    line = json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n'
+                present.add(content_digest(message['content']))
+            result.append(line)
+        return result
+
+    def __prepare_history__(self):
+        self.check_and_create(self.history_file)
+        if self.history_file in Cacher.utf8_histories: return
+
+        with open(self.history_file, 'rb') as file:
+            lines = file.readlines()
+        try:
+            b''.join(lines).decode('utf-8')
+        except UnicodeDecodeError:
+            # Histories used to be written in a locale encoding, such lines are converted while UTF-8 ones appended since are kept.
+            legacy_encoding = locale.getpreferredencoding(False)
+            with open(self.history_file, 'wb') as file:
+                for line in lines:
+                    try:
+                        line.decode('utf-8')
+                    except UnicodeDecodeError:
+                        line = line.decode(legacy_encoding, errors='replace').encode('utf-8')
+                    file.write(line)
+            self.history_index.invalidate()
+        Cacher.utf8_histories.add(self.history_file)
+
+    def __save_content_digests__(self, digests: Set[str]):
+        with open(self.content_digests_file, 'w') as file:
+            json.dump(sorted(digests), file)
+
+    def __drop_content_digests__(self):
+        if os.path.isfile(self.content_digests_file):
+            os.remove(self.content_digests_file)
+
+    def __current_segment__(self, segment_size_kb: int) -> str:
+        if not os.path.exists(self.archive_dir):
+            os.makedirs(self.archive_dir)
+
+        segments = self.archive_segments()
+        if segments and os.path.getsize(segments[-1]) < segment_size_kb * 1024:
+            return segments[-1]
+
+        index = int(os.path.basename(segments[-1]).split('.')[0].split('_')[-1]) + 1 if segments else 1
+        return os.path.join(self.archive_dir, f"segment_{index:06d}.jl.gz")
+
+    def __starts_exchange__(self, previous_line: bytes, line: bytes) -> bool:
+        try:
+            return json.loads(previous_line).get('role') == 'assistant' and json.loads(line).get('role') == 'user'
+        except JSONDecodeError:
+            return False
@@ -0,0 +1,186 @@
+import functools
+import time
+from dataclasses import dataclass
+from threading import Event, Thread
+from typing import Dict, List, Optional, Set
+
+import sublime
+from sublime import View, Window
+from sublime_plugin import WindowCommand
+
+from .assistant_settings import AssistantSettings, DEFAULT_ASSISTANT_SETTINGS
+from .metrics import record_metric
+from .openai_network_client import NetworkClient, sse_chunks
+
+
+@dataclass
+class StreamStats():
+    ttft: Optional[float] = None
+    duration: float = 0
+    # Streamed deltas with content, a single delta may carry several tokens.
+    chunks: int = 0
+    # Reported by a server at the end of a stream, not every provider does that.
+    completion_tokens: Optional[int] = None
+    error: Optional[str] = None
+
+    def summary(self) -> str:
+        if self.error:
+            return f"failed after {self.duration:.2f}s: {self.error}"
+        ttft = f"{self.ttft:.2f}s" if self.ttft is not None else "-"
+        count, unit = (self.completion_tokens, 'tokens') if self.completion_tokens is not None else (self.chunks, 'chunks')
+        rate = count / self.duration if self.duration > 0 else 0
+        return f"TTFT {ttft} | {self.duration:.2f}s total | {count} {unit} ({rate:.1f} {unit}/s)"
+
+
+def view_name(assistant: AssistantSettings, model: str) -> str:
+    return f"OpenAI: {assistant.name} | {model}"
+
+
+class ComparisonStream(Thread):
+    def __init__(self, assistant: AssistantSettings, messages: List[Dict[str, str]], view: View, stop_event: Event) -> None:
+        self.assistant = assistant
+        self.messages = messages
+        self.view = view
+        self.stop_event = stop_event
+        self.stats = StreamStats()
+        # The one that actually answers, it differs from `chat_model` once an assistant routes between `models`.
+        self.model = assistant.chat_model
+        super(ComparisonStream, self).__init__()
+
+    def append(self, text: str):
+        self.view.set_read_only(False)
+        self.view.run_command('append', {'characters': text})
+        self.view.set_read_only(True)
+
+    def run(self):
+        started_at = time.time()
+        provider: Optional[NetworkClient] = None
+        try:
+            provider = NetworkClient(settings=sublime.load_settings("openAI.sublime-settings"), assistant=self.assistant)
+            payload = provider.prepare_payload(assitant_setting=self.assistant, messages=self.messages, with_history=False, include_usage=True)
+            if provider.routing_decision:
+                self.model = provider.routing_decision.model
+                self.view.set_name(view_name(assistant=self.assistant, model=self.model))
+            provider.prepare_request(json_payload=payload)
+            response = provider.execute_response()
+
+            for chunk in sse_chunks(provider.iterate_response(response)):
+                if self.stop_event.is_set():
+                    self.append("\n\n[Aborted]")
+                    break
+                if (chunk.get('usage') or {}).get('completion_tokens') is not None:
+                    self.stats.completion_tokens = chunk['usage']['completion_tokens']
+                delta = chunk['choices'][0].get('delta', {}) if chunk.get('choices') else {}
+                if not delta.get('content'): continue
+                if self.stats.ttft is None:
+                    self.stats.ttft = time.time() - started_at
+                self.stats.chunks += 1
+                self.append(delta['content'])
+        except Exception as error:
+            self.stats.error = str(error)
+        finally:
+            if provider:
+                provider.connection.close()
+
+        self.stats.duration = time.time() - started_at
+        self.append(f"\n\n---\n\n{self.stats.summary()}\n")
+        record_metric(
+            'comparison_stream',
+            assistant=self.assistant.name,
+            model=self.model,
+            ttft=self.stats.ttft,
+            duration=self.stats.duration,
+            tokens=self.stats.completion_tokens,
+            chunks=self.stats.chunks,
+            error=self.stats.error
+        )
+
+
+class OpenaiCompareAssistantsCommand(WindowCommand):
+    """Sends the same selection and question to several assistants at once, each answer streams into its own tab."""
+    stop_event: Event = Event()
+    streams: List[ComparisonStream] = []
+
+    def run(self):
+        settings = sublime.load_settings("openAI.sublime-settings")
+        assistants = [
+            AssistantSettings(**{**DEFAULT_ASSISTANT_SETTINGS, **assistant})
+            for assistant in settings.get('assistants', [])
+        ]
+        view = self.window.active_view()
+        text = ''.join(view.substr(region) for region in view.sel() if not region.empty()) if view else ''
+        scope_name = view.scope_name(view.sel()[0].begin()).split('.')[-1].strip() if view and text else ''
+        self.show_assistants(assistants=assistants, picked=set(), text=text, scope_name=scope_name)
+
+    def show_assistants(self, assistants: List[AssistantSettings], picked: Set[int], text: str, scope_name: str, selected_index: int = 0):
+        items = [f"Compare {len(picked)} picked assistants"] + [
+            f"{'[x]' if index in picked else '[ ]'} {assistant.name} | {assistant.prompt_mode} | {assistant.chat_model}"
+            for index, assistant in enumerate(assistants)
+        ]
+        self.window.show_quick_panel(
+            items,
+            functools.partial(self.on_pick, assistants, picked, text, scope_name),
+            selected_index=selected_index
+        )
+
+    def on_pick(self, assistants: List[AssistantSettings], picked: Set[int], text: str, scope_name: str, index: int):
+        if index == -1: return
+        if index > 0:
+            # Toggling an assistant and showing the list again until the first item is picked.
+            picked = picked ^ {index - 1}
+            sublime.set_timeout(functools.partial(self.show_assistants, assistants, picked, text, scope_name, index), 0)
+            return
+        if not picked: return
+
+        self.window.show_input_panel(
+            "Question: ",
+            "",
+            functools.partial(self.start, [assistants[index] for index in sorted(picked)], text, scope_name),
+            None,
+            None
+        )
+
+    def start(self, assistants: List[AssistantSettings], text: str, scope_name: str, question: str):
+        OpenaiCompareAssistantsCommand.stop_worker()
+        OpenaiCompareAssistantsCommand.stop_event = Event()
+
+        messages = []
+        if text: messages.append({"role": "user", "content": f"```{scope_name}\n" + text + "\n```", 'name': 'OpenAI_completion'})
+        if question: messages.append({"role": "user", "content": question, 'name': 'OpenAI_completion'})
+
+        streams = [
+            ComparisonStream(assistant=assistant, messages=messages, view=self.create_view(window=self.window, assistant=assistant, question=question), stop_event=OpenaiCompareAssistantsCommand.stop_event)
+            for assistant in assistants
+        ]
+        OpenaiCompareAssistantsCommand.streams = streams
+        for stream in streams:
+            stream.start()
+        Thread(target=self.summarize, args=(self.window, streams), daemon=True).start()
+
+    def create_view(self, window: Window, assistant: AssistantSettings, question: str) -> View:
+        view = window.new_file()
+        view.set_scratch(True)
+        view.set_name(view_name(assistant=assistant, model=assistant.chat_model))
+        view.settings().set("line_numbers", False)
+        if sublime.load_settings("openAI.sublime-settings").get('markdown', True):
+            view.set_syntax_file("Packages/Markdown/MultiMarkdown.sublime-syntax")
+        view.run_command('append', {'characters': f"## Question\n\n{question}\n\n## Answer\n\n"})
+        view.set_read_only(True)
+        return view
+
+    def summarize(self, window: Window, streams: List[ComparisonStream]):
+        for stream in streams:
+            stream.join()
+        summary = '\n'.join(f"{stream.assistant.name} | {stream.model}: {stream.stats.summary()}" for stream in streams)
+        print(f"OpenAI comparison:\n{summary}")
+        sublime.set_timeout(lambda: window.status_message(f"OpenAI: compared {len(streams)} assistants, see each tab for timings"), 0)
+
+    @classmethod
+    def is_running(cls) -> bool:
+        return any(stream.is_alive() for stream in cls.streams)
+
+    @classmethod
+    def stop_worker(cls):
+        if cls.is_running():
+            cls.stop_event.set()
+        cls.streams = []
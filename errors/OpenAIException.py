@@ -18,6 +18,17 @@ class UnknownException(OpenAIException): ...
 
 class WrongUserInputException(OpenAIException): ...
 
+class RequestTimeoutException(OpenAIException):
+    """Base for requests that took longer than one of the `timeouts` allows."""
+
+class ConnectTimeoutException(RequestTimeoutException): ...
+
+class FirstByteTimeoutException(RequestTimeoutException): ...
+
+class IdleTimeoutException(RequestTimeoutException): ...
+
+class DeadlineExceededException(RequestTimeoutException): ...
+
 def present_error(title: str, error: OpenAIException):
     exception(f"{title}: {error.message}")
     error_message(f"{title}\n{error.message}")
@@ -0,0 +1,166 @@
+import json
+import os
+import re
+from threading import RLock
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from . import jl_utility as jl
+
+PREVIEW_LENGTH = 120
+# The amount of incremental updates after which they're merged into the main index file.
+COMPACTION_THRESHOLD = 256
+
+# Loaded indexes shared between instances, keyed by the index path. Invalidated by a modification time change.
+__loaded_indexes__: Dict[str, Tuple[float, float, Dict]] = {}
+# Searches run on the async thread while a worker thread updates the very same loaded index.
+__index_lock__ = RLock()
+
+
+def tokenize(text: str) -> Set[str]:
+    return {token for token in re.findall(r'\w+', text.lower()) if len(token) > 1}
+
+
+class HistoryIndex():
+    """Inverted index over both active and archived chat history.
+
+    Every message gets a sequence number that never changes, while archiving just moves
+    the boundary between archived and active messages. The index is stored as a json file
+    plus a json lines file of incremental updates, so nothing rewrites the whole index per message.
+    """
+
+    def __init__(self, index_file: str) -> None:
+        self.index_file = index_file
+        self.updates_file = f"{os.path.splitext(index_file)[0]}_updates.jl"
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.index_file)
+
+    def invalidate(self):
+        with __index_lock__:
+            for path in (self.index_file, self.updates_file):
+                if os.path.isfile(path):
+                    os.remove(path)
+            __loaded_indexes__.pop(self.index_file, None)
+
+    def rebuild(self, active: Iterable[Dict[str, str]], archive: Iterable[Tuple[str, Iterable[Dict[str, str]]]]):
+        with __index_lock__:
+            index: Dict = {'next_seq': 0, 'active_base': 0, 'segments': {}, 'docs': {}, 'postings': {}}
+            for segment, messages in archive:
+                index['segments'][segment] = [index['next_seq'], 0]
+                for message in messages:
+                    self.__add_document__(index, message)
+                    index['segments'][segment][1] += 1
+            index['active_base'] = index['next_seq']
+            for message in active:
+                self.__add_document__(index, message)
+            self.__save__(index)
+
+    def add_active(self, messages: List[Dict[str, str]]):
+        self.__update__([{'message': message} for message in messages])
+
+    def archive(self, number: int, segment: str):
+        self.__update__([{'archived': number, 'segment': segment}])
+
+    def locate(self, seq: int) -> Optional[Tuple[Optional[str], int]]:
+        """Returns `(segment, line)` of a message, where segment is None for the active history."""
+        with __index_lock__:
+            index = self.__load__()
+            if seq >= index['active_base']:
+                return None, seq - index['active_base']
+            for segment, (first_seq, count) in index['segments'].items():
+                if first_seq <= seq < first_seq + count:
+                    return segment, seq - first_seq
+            return None
+
+    def search(self, query: str, limit: int = 200) -> List[Tuple[int, str, str]]:
+        """Returns `(seq, role, preview)` of messages containing every word of a query, the most recent first.
+
+        The last word of a query matches as a prefix, so results are there while a word is still being typed.
+        """
+        with __index_lock__:
+            tokens = re.findall(r'\w+', query.lower())
+            if not tokens: return []
+
+            index = self.__load__()
+            postings = index['postings']
+            *complete_tokens, last_token = tokens
+
+            matches: Optional[Set[int]] = None
+            for token in complete_tokens:
+                matches = set(postings.get(token, [])) if matches is None else matches & set(postings.get(token, []))
+                if not matches: return []
+
+            prefixed: Set[int] = set()
+            for token, seqs in postings.items():
+                if token.startswith(last_token):
+                    prefixed.update(seqs)
+            matches = prefixed if matches is None else matches & prefixed
+
+            results = sorted(matches, reverse=True)[:limit]
+            return [(seq, *index['docs'][str(seq)]) for seq in results]
+
+    def __update__(self, updates: List[Dict]):
+        with __index_lock__:
+            # Nothing to update, the index would be built from scratch on the first search.
+            if not self.exists(): return
+
+            index = self.__load__()
+            writer = jl.writer(self.updates_file)
+            next(writer)
+            for update in updates:
+                self.__apply__(index, update)
+                writer.send(update)
+            writer.close()
+
+            if index['updates_count'] >= COMPACTION_THRESHOLD:
+                self.__save__(index)
+            else:
+                self.__remember__(index)
+
+    def __apply__(self, index: Dict, update: Dict):
+        if 'message' in update:
+            self.__add_document__(index, update['message'])
+        elif 'archived' in update:
+            first_seq, count = index['segments'].get(update['segment'], [index['active_base'], 0])
+            index['segments'][update['segment']] = [first_seq, count + update['archived']]
+            index['active_base'] += update['archived']
+        index['updates_count'] = index.get('updates_count', 0) + 1
+
+    def __add_document__(self, index: Dict, message: Dict[str, str]):
+        seq = index['next_seq']
+        content = message.get('content', '')
+        index['docs'][str(seq)] = [message.get('role', ''), content.strip().split('\n')[0][:PREVIEW_LENGTH]]
+        for token in tokenize(content):
+            index['postings'].setdefault(token, []).append(seq)
+        index['next_seq'] += 1
+
+    def __load__(self) -> Dict:
+        index_mtime = os.path.getmtime(self.index_file)
+        updates_mtime = os.path.getmtime(self.updates_file) if os.path.isfile(self.updates_file) else 0
+        loaded = __loaded_indexes__.get(self.index_file)
+        if loaded and loaded[0] == index_mtime and loaded[1] == updates_mtime:
+            return loaded[2]
+
+        with open(self.index_file, 'r', encoding='utf-8') as file:
+            index = json.load(file)
+
+        if os.path.isfile(self.updates_file):
+            for update in jl.reader(self.updates_file):
+                self.__apply__(index, update)
+
+        self.__remember__(index)
+        return index
+
+    def __save__(self, index: Dict):
+        index['updates_count'] = 0
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump(index, file, ensure_ascii=False)
+        os.replace(temp_file, self.index_file)
+        if os.path.isfile(self.updates_file):
+            os.remove(self.updates_file)
+        self.__remember__(index)
+
+    def __remember__(self, index: Dict):
+        updates_mtime = os.path.getmtime(self.updates_file) if os.path.isfile(self.updates_file) else 0
+        __loaded_indexes__[self.index_file] = (os.path.getmtime(self.index_file), updates_mtime, index)
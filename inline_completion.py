@@ -0,0 +1,214 @@
+import functools
+import hashlib
+import html
+import socket
+import time
+from collections import OrderedDict
+from threading import Event, Thread
+from typing import Dict, Optional, Tuple
+
+import sublime
+from sublime import Edit, Phantom, PhantomSet, Region, View
+from sublime_plugin import EventListener, TextCommand
+
+from .assistant_settings import AssistantSettings, DEFAULT_ASSISTANT_SETTINGS, PromptMode
+from .cacher import Cacher
+from .openai_network_client import NetworkClient, sse_deltas
+from .stream_guard import strip_code_fence
+
+CURSOR_MARKER = '<CURSOR>'
+CACHE_SIZE = 256
+
+
+class InlineCompletionRequest(Thread):
+    """Fetches a single suggestion, dropping it if it's cancelled or exceeds the latency budget."""
+
+    def __init__(self, assistant: AssistantSettings, prefix: str, suffix: str, deadline: float, on_done) -> None:
+        self.assistant = assistant
+        self.prefix = prefix
+        self.suffix = suffix
+        self.deadline = deadline
+        self.on_done = on_done
+        self.stop_event = Event()
+        self.provider: Optional[NetworkClient] = None
+        super(InlineCompletionRequest, self).__init__(daemon=True)
+
+    def cancel(self):
+        self.stop_event.set()
+        if not self.provider: return
+        # Closing a connection waits until a read in flight returns, while shutting its socket down interrupts that read right away.
+        sock = self.provider.sock or self.provider.connection.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.provider.connection.close()
+
+    def run(self):
+        settings = sublime.load_settings("openAI.sublime-settings")
+        messages = [{
+            "role": "user",
+            "content": f"{self.prefix}{CURSOR_MARKER}{self.suffix}",
+            'name': 'OpenAI_completion'
+        }]
+        try:
+            self.provider = NetworkClient(settings=settings, assistant=self.assistant)
+            self.provider.timeouts['total'] = max(self.deadline - time.time(), 0.01)
+            payload = self.provider.prepare_payload(assitant_setting=self.assistant, messages=messages, with_history=False)
+            # A cancel before a socket is there has nothing to shut down, so it's caught around connecting instead.
+            if self.stop_event.is_set(): return
+            self.provider.prepare_request(json_payload=payload)
+            if self.stop_event.is_set(): return
+            response = self.provider.execute_response()
+
+            completion = []
+            for delta in sse_deltas(self.provider.iterate_response(response)):
+                if self.stop_event.is_set() or time.time() > self.deadline: return
+                completion.append(delta.get('content') or '')
+        except Exception as error:
+            # Cancelled requests fail on a closed socket, and there's no point to bother a user with a missed suggestion.
+            if not self.stop_event.is_set():
+                print(f"OpenAI inline completion dropped: {error}")
+            return
+        finally:
+            if self.provider:
+                self.provider.connection.close()
+
+        if self.stop_event.is_set() or time.time() > self.deadline: return
+        self.on_done(strip_code_fence(''.join(completion)))
+
+
+class InlineCompletionListener(EventListener):
+    """Shows suggestions as phantoms while typing, once an `inline` assistant is selected.
+
+    Requests are debounced and every modification cancels the one in-flight,
+    while completions are cached by their context, so undo or retyping shows them instantly.
+    """
+    assistant: Optional[AssistantSettings] = None
+    assistant_loaded: bool = False
+    generations: Dict[int, int] = {}
+    in_flight: Dict[int, InlineCompletionRequest] = {}
+    suggestions: Dict[int, Tuple[int, str]] = {}
+    phantom_sets: Dict[int, PhantomSet] = {}
+    completions_cache: 'OrderedDict[str, str]' = OrderedDict()
+
+    @classmethod
+    def set_assistant(cls, assistant: Optional[AssistantSettings]):
+        cls.assistant = assistant if assistant and assistant.prompt_mode == PromptMode.inline.value else None
+        cls.assistant_loaded = True
+
+    @classmethod
+    def current_assistant(cls) -> Optional[AssistantSettings]:
+        if not cls.assistant_loaded:
+            assistant_dict = Cacher().read_model()
+            cls.set_assistant(AssistantSettings(**{**DEFAULT_ASSISTANT_SETTINGS, **assistant_dict}) if assistant_dict else None)
+        return cls.assistant
+
+    def on_modified_async(self, view: View):
+        assistant = self.current_assistant()
+        if not assistant or not self.is_applicable(view): return
+
+        generation = self.generations.get(view.id(), 0) + 1
+        self.generations[view.id()] = generation
+        self.cancel_in_flight(view)
+        sublime.set_timeout(functools.partial(self.hide_suggestion, view), 0)
+
+        settings = sublime.load_settings("openAI.sublime-settings")
+        sublime.set_timeout_async(
+            functools.partial(self.request_suggestion, view, generation, assistant),
+            settings.get('inline_completion_debounce_ms', 300)
+        )
+
+    def on_selection_modified_async(self, view: View):
+        suggestion = self.suggestions.get(view.id())
+        if suggestion and (len(view.sel()) != 1 or view.sel()[0].b != suggestion[0]):
+            sublime.set_timeout(functools.partial(self.hide_suggestion, view), 0)
+
+    def on_close(self, view: View):
+        self.cancel_in_flight(view)
+        for state in (self.generations, self.suggestions, self.phantom_sets):
+            state.pop(view.id(), None)
+
+    def on_query_context(self, view: View, key: str, operator, operand, match_all):
+        if key == "openai_inline_suggestion_visible":
+            return view.id() in self.suggestions
+        return None
+
+    def is_applicable(self, view: View) -> bool:
+        return (
+            not view.settings().get('is_widget')
+            and not view.is_read_only()
+            and view.element() is None
+            and len(view.sel()) == 1
+            and view.sel()[0].empty()
+        )
+
+    def request_suggestion(self, view: View, generation: int, assistant: AssistantSettings):
+        # A user typed again within a debounce interval.
+        if self.generations.get(view.id()) != generation or not view.is_valid(): return
+        if not self.is_applicable(view): return
+
+        settings = sublime.load_settings("openAI.sublime-settings")
+        point = view.sel()[0].b
+        prefix = view.substr(Region(max(0, point - settings.get('inline_completion_prefix_chars', 2000)), point))
+        suffix = view.substr(Region(point, min(view.size(), point + settings.get('inline_completion_suffix_chars', 500))))
+
+        cache_key = hashlib.sha1('\0'.join([assistant.chat_model, assistant.assistant_role, prefix, suffix]).encode('utf-8')).hexdigest()
+        cached = self.completions_cache.get(cache_key)
+        if cached is not None:
+            self.completions_cache.move_to_end(cache_key)
+            sublime.set_timeout(functools.partial(self.show_suggestion, view, generation, point, cached), 0)
+            return
+
+        def on_done(completion: str):
+            self.completions_cache[cache_key] = completion
+            if len(self.completions_cache) > CACHE_SIZE:
+                self.completions_cache.popitem(last=False)
+            sublime.set_timeout(functools.partial(self.show_suggestion, view, generation, point, completion), 0)
+
+        budget = settings.get('inline_completion_latency_budget_ms', 2000) / 1000
+        request = InlineCompletionRequest(assistant=assistant, prefix=prefix, suffix=suffix, deadline=time.time() + budget, on_done=on_done)
+        self.in_flight[view.id()] = request
+        request.start()
+
+    def cancel_in_flight(self, view: View):
+        request = self.in_flight.pop(view.id(), None)
+        if request:
+            request.cancel()
+
+    def show_suggestion(self, view: View, generation: int, point: int, completion: str):
+        if self.generations.get(view.id()) != generation or not completion.strip(): return
+        if len(view.sel()) != 1 or view.sel()[0].b != point: return
+
+        self.in_flight.pop(view.id(), None)
+        self.suggestions[view.id()] = (point, completion)
+        phantom_set = self.phantom_sets.setdefault(view.id(), PhantomSet(view, 'openai_inline_completion'))
+        content = html.escape(completion).replace('\n', '<br>').replace(' ', '&nbsp;')
+        layout = sublime.LAYOUT_INLINE if '\n' not in completion else sublime.LAYOUT_BLOCK
+        phantom_set.update([Phantom(
+            Region(point),
+            f'<body id="openai-inline-completion"><span style="color: color(var(--foreground) alpha(0.5))">{content}</span></body>',
+            layout
+        )])
+
+    @classmethod
+    def hide_suggestion(cls, view: View):
+        cls.suggestions.pop(view.id(), None)
+        phantom_set = cls.phantom_sets.get(view.id())
+        if phantom_set:
+            phantom_set.update([])
+
+
+class OpenaiAcceptInlineSuggestionCommand(TextCommand):
+    def run(self, edit: Edit):
+        suggestion = InlineCompletionListener.suggestions.get(self.view.id())
+        InlineCompletionListener.hide_suggestion(self.view)
+        if suggestion:
+            point, completion = suggestion
+            self.view.insert(edit=edit, pt=point, text=completion)
+
+
+class OpenaiDismissInlineSuggestionCommand(TextCommand):
+    def run(self, edit: Edit):
+        InlineCompletionListener.hide_suggestion(self.view)
@@ -1,22 +1,31 @@
+import gzip
 import json
 from typing import Iterator, Generator
 
 
 def reader(fname: str) -> Iterator[dict]:
-    with open(fname) as file:
+    with open(fname, encoding='utf-8') as file:
         for line in file:
             obj = json.loads(line.strip())
             yield obj
 
 
 def writer(fname: str, mode: str = 'a') -> Generator[None, dict, None]:
-    with open(fname, mode) as file:
+    # Lines are sent to the API as they are, so they're stored in UTF-8 whatever a system locale is.
+    with open(fname, mode, encoding='utf-8') as file:
         while True:
             obj = yield
             line = json.dumps(obj, ensure_ascii=False)
             file.write(f"{line}\n")
 
 
+def compressed_reader(fname: str) -> Iterator[dict]:
+    with gzip.open(fname, 'rt', encoding='utf-8') as file:
+        for line in file:
+            obj = json.loads(line.strip())
+            yield obj
+
+
 # if __name__ == "__main__":
 #     # Read employees from employees.jl
 #     reader = jl_reader("employees.jl")
@@ -0,0 +1,17 @@
+import time
+from threading import Lock
+from typing import Any
+
+from . import jl_utility as jl
+from .cacher import Cacher
+
+__lock__ = Lock()
+
+
+def record_metric(event: str, **fields: Any):
+    """Appends an event to `metrics.jl` within the plugin cache folder."""
+    with __lock__:
+        writer = jl.writer(Cacher().metrics_file)
+        next(writer)
+        writer.send({'event': event, 'timestamp': time.time(), **fields})
+        writer.close()
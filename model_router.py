@@ -0,0 +1,57 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+from .assistant_settings import AssistantSettings
+
+# Roughly 4 characters per token for a normal English text (and a bit worse for code).
+BYTES_PER_TOKEN = 4
+
+
+class LatencyClass(Enum):
+    fast = "fast"
+    medium = "medium"
+    slow = "slow"
+
+
+LATENCY_ORDER = [LatencyClass.fast.value, LatencyClass.medium.value, LatencyClass.slow.value]
+
+
+@dataclass
+class RoutingDecision():
+    model: str
+    estimated_tokens: int
+    context_window: Optional[int]
+    # Whether none of the candidates fits and the largest one was picked.
+    overflow: bool = False
+
+
+def latency_rank(candidate: Dict[str, Any]) -> int:
+    # A missing or mistyped latency class is treated as `medium` rather than failing a request.
+    latency = candidate.get('latency', LatencyClass.medium.value)
+    return LATENCY_ORDER.index(latency) if latency in LATENCY_ORDER else LATENCY_ORDER.index(LatencyClass.medium.value)
+
+
+def estimate_tokens(byte_size: int) -> int:
+    return byte_size // BYTES_PER_TOKEN + 1
+
+
+def route_model(assistant: AssistantSettings, prompt_tokens: int) -> RoutingDecision:
+    """Picks the fastest of `assistant.models` which context window fits the prompt plus `max_tokens`.
+
+    Models of the same latency class are tried in the order they're listed,
+    an assistant without `models` always goes with its `chat_model`.
+    """
+    candidates: List[Dict[str, Any]] = assistant.models or []
+    if not candidates:
+        return RoutingDecision(model=assistant.chat_model, estimated_tokens=prompt_tokens, context_window=None)
+
+    required_tokens = prompt_tokens + assistant.max_tokens
+    ordered = sorted(candidates, key=latency_rank)
+    for candidate in ordered:
+        context_window = candidate.get('context_window')
+        if context_window is None or context_window >= required_tokens:
+            return RoutingDecision(model=candidate['name'], estimated_tokens=prompt_tokens, context_window=context_window)
+
+    largest = max(candidates, key=lambda candidate: candidate.get('context_window', 0))
+    return RoutingDecision(model=largest['name'], estimated_tokens=prompt_tokens, context_window=largest.get('context_window'), overflow=True)
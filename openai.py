@@ -3,12 +3,14 @@ from typing import List, Optional
 from threading import Event
 import sublime
 from sublime_plugin import TextCommand, EventListener
-from sublime import Settings, View, Region, Edit
+from sublime import Settings, View, Region, Edit, Window
 import functools
+import os
 from .cacher import Cacher
 from .errors.OpenAIException import WrongUserInputException, present_error
-from .assistant_settings import CommandMode
+from .assistant_settings import AssistantSettings, CommandMode, DEFAULT_ASSISTANT_SETTINGS, PromptMode
 from .openai_worker import OpenAIWorker
+from .openai_network_client import ConnectionPrewarmer
 
 class Openai(TextCommand):
     stop_event: Event = Event()
@@ -60,6 +62,9 @@ class Openai(TextCommand):
             output_panel.erase(edit, region)
             output_panel.set_read_only(True)
 
+        elif mode == CommandMode.restore_archived_history.value:
+            self.show_archived_segments(window=sublime.active_window())
+
         elif mode == CommandMode.create_new_tab.value:
             window = sublime.active_window()
             listner = SharedOutputPanelListener(markdown=settings.get('markdown'))
@@ -75,6 +80,13 @@ class Openai(TextCommand):
             listner.show_panel(window=window)
 
         elif mode == CommandMode.chat_completion.value:
+            assistant = Cacher().read_model()
+            if assistant and assistant.get('prompt_mode') == PromptMode.inline.value:
+                sublime.active_window().status_message("OpenAI: Inline assistant is selected, suggestions show up while typing")
+                return
+
+            # Connecting in advance, while a user types a question.
+            ConnectionPrewarmer.warm_up(settings=settings, assistant=AssistantSettings(**{**DEFAULT_ASSISTANT_SETTINGS, **assistant}) if assistant else None)
             sublime.active_window().show_input_panel(
                 "Question: ",
                 "",
@@ -89,6 +101,30 @@ class Openai(TextCommand):
                 None
             )
 
+    def show_archived_segments(self, window: Window):
+        cacher = Cacher()
+        segments = cacher.archive_segments()
+        if not segments:
+            window.status_message("OpenAI: There's no archived chat history")
+            return
+
+        items: List[List[str]] = []
+        for segment in segments:
+            # Streaming just the first question of a segment, there's no need to decompress it whole.
+            first_question = next((message['content'] for message in cacher.read_segment(segment) if message['role'] == 'user'), '')
+            items.append([os.path.basename(segment), first_question.strip().split('\n')[0][:120]])
+
+        window.show_quick_panel(items, functools.partial(self.on_archived_segment_selected, window, segments))
+
+    def on_archived_segment_selected(self, window: Window, segments: List[str], index: int):
+        from .output_panel import SharedOutputPanelListener # https://stackoverflow.com/a/52927102
+
+        if index == -1: return
+        Cacher().restore_segment(segments[index])
+        listner = SharedOutputPanelListener(markdown=settings.get('markdown'))
+        listner.refresh_output_panel(window=window)
+        listner.show_panel(window=window)
+
     # TODO: To chech if this is even necessary
     @classmethod
     def stop_worker(cls):
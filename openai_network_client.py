@@ -1,87 +1,320 @@
 import json
-from base64 import b64encode
-from http.client import HTTPConnection, HTTPResponse, HTTPSConnection, responses
-from typing import Dict, List, Optional
+import re
+import socket
+import time
+from http.client import HTTPConnection, HTTPException, HTTPResponse
+from threading import Lock, Thread, Timer
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Type
 
 import sublime
 
 from .assistant_settings import AssistantSettings, PromptMode
 from .cacher import Cacher
-from .errors.OpenAIException import ContextLengthExceededException, UnknownException
+from .errors.OpenAIException import ConnectTimeoutException, DeadlineExceededException, FirstByteTimeoutException, IdleTimeoutException, RequestTimeoutException
+from .model_router import RoutingDecision, estimate_tokens, route_model
+from .metrics import record_metric
+from .providers import Provider, create_provider
+
+DEFAULT_TIMEOUTS: Dict[str, float] = {'connect': 10, 'first_byte': 60, 'idle': 30, 'total': 600}
+
+TIMEOUT_ERRORS: Dict[str, Type[RequestTimeoutException]] = {
+    'connect': ConnectTimeoutException,
+    'first_byte': FirstByteTimeoutException,
+    'idle': IdleTimeoutException,
+    'total': DeadlineExceededException,
+}
+
+TIMEOUT_MESSAGES: Dict[str, str] = {
+    'connect': "Couldn't connect and send a request within {timeout}s.",
+    'first_byte': "The server hasn't started to answer within {timeout}s.",
+    'idle': "The answer has stalled for more than {timeout}s.",
+    'total': "The request hasn't finished within {timeout}s.",
+}
+
+
+def load_timeouts(settings: sublime.Settings, assistant: Optional[AssistantSettings] = None) -> Dict[str, float]:
+    """Assistant `timeouts` take precedence over the global ones, key by key."""
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    for overrides in (settings.get('timeouts'), assistant.timeouts if assistant else None):
+        if isinstance(overrides, dict):
+            timeouts.update({key: value for key, value in overrides.items() if key in DEFAULT_TIMEOUTS and isinstance(value, (int, float)) and value > 0})
+    return timeouts
+
+
+class ConnectionPrewarmer():
+    """Opens a connection speculatively while a user is still picking an assistant or typing a question.
+
+    DNS lookup, TCP and TLS handshakes and a proxy tunnel setup happen in a background thread,
+    and the next `NetworkClient` takes the connection over if it was made for the same endpoint and proxy.
+    An unclaimed connection gets closed after a timeout.
+    """
+    lock: Lock = Lock()
+    connection: Optional[HTTPConnection] = None
+    key: Optional[str] = None
+    expiration_timer: Optional[Timer] = None
+
+    @classmethod
+    def warm_up(cls, settings: sublime.Settings, assistant: Optional[AssistantSettings] = None):
+        if not settings.get('connection_prewarm', True): return
+        backend = create_provider(settings=settings, assistant=assistant)
+        key = backend.connection_key(settings.get('proxy'))
+        with cls.lock:
+            if cls.key == key: return
+            cls.discard_locked()
+            cls.key = key
+
+        Thread(target=cls.connect, args=(settings, backend, key, assistant), daemon=True).start()
+
+    @classmethod
+    def connect(cls, settings: sublime.Settings, backend: Provider, key: str, assistant: Optional[AssistantSettings] = None):
+        connection = backend.create_connection(proxy_settings=settings.get('proxy'))
+        connection.timeout = load_timeouts(settings=settings, assistant=assistant)['connect']
+        try:
+            connection.connect()
+        except Exception as error:
+            # Not a big deal, the request would establish its own connection.
+            print(f"OpenAI: connection prewarm failed: {error}")
+            connection.close()
+            with cls.lock:
+                if cls.key == key: cls.key = None
+            return
+
+        with cls.lock:
+            # Another prewarm or the request itself took place while this one was connecting.
+            if cls.key != key or cls.connection is not None:
+                connection.close()
+                return
+            cls.connection = connection
+            cls.expiration_timer = Timer(settings.get('connection_prewarm_timeout', 30), cls.discard)
+            cls.expiration_timer.daemon = True
+            cls.expiration_timer.start()
+
+    @classmethod
+    def take(cls, key: str) -> Optional[HTTPConnection]:
+        with cls.lock:
+            connection = cls.connection if cls.key == key else None
+            if connection:
+                cls.connection = None
+            cls.discard_locked()
+            return connection
+
+    @classmethod
+    def discard(cls):
+        with cls.lock:
+            cls.discard_locked()
+
+    @classmethod
+    def discard_locked(cls):
+        if cls.expiration_timer:
+            cls.expiration_timer.cancel()
+            cls.expiration_timer = None
+        if cls.connection:
+            cls.connection.close()
+            cls.connection = None
+        cls.key = None
+
+
+def serialize_message(message: Dict[str, str]) -> bytes:
+    # Has to match the way `jl_utility.writer` stores messages in the history.
+    return json.dumps(message, ensure_ascii=False).encode('utf-8')
+
+
+class ChatPayload():
+    """Request body assembled from already serialized json fragments.
+
+    It's sent to a connection in chunks of `CHUNK_SIZE` bytes,
+    so the whole body is never joined into a single string.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fragments: List[bytes]) -> None:
+        self.fragments = fragments
+
+    def __len__(self) -> int:
+        return sum(len(fragment) for fragment in self.fragments)
+
+    def __iter__(self) -> Iterator[bytes]:
+        chunk: List[bytes] = []
+        chunk_size = 0
+        for fragment in self.fragments:
+            chunk.append(fragment)
+            chunk_size += len(fragment)
+            if chunk_size >= self.CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk, chunk_size = [], 0
+        if chunk:
+            yield b''.join(chunk)
+
+    def __bytes__(self) -> bytes:
+        return b''.join(self.fragments)
+
+
+def sse_chunks(lines: Iterable[bytes]) -> Iterator[Dict[str, Any]]:
+    """Yields chunk objects of a streamed chat completion response, e.g. of `NetworkClient.iterate_response`."""
+    for chunk in lines:
+        chunk_str = chunk.decode('utf-8')
+        if chunk_str.startswith("data:") and not re.search(r"\[DONE\]$", chunk_str):
+            yield json.loads(chunk_str[len("data:"):].strip())
+
+
+def sse_deltas(lines: Iterable[bytes]) -> Iterator[Dict[str, Any]]:
+    """Yields `delta` objects of a streamed chat completion response, e.g. of `NetworkClient.iterate_response`."""
+    for data in sse_chunks(lines):
+        if data.get('choices') and 'delta' in data['choices'][0]:
+            yield data['choices'][0]['delta']
 
 
 class NetworkClient():
     response: Optional[HTTPResponse] = None
+    routing_decision: Optional[RoutingDecision] = None
+    sock: Optional[socket.socket] = None
+    deadline: float = 0
+    # Which of the `timeouts` a socket operation in progress is bounded by.
+    timeout_kind: str = 'connect'
 
-    def __init__(self, settings: sublime.Settings, cacher: Cacher = Cacher()) -> None:
+    def __init__(self, settings: sublime.Settings, cacher: Cacher = Cacher(), assistant: Optional[AssistantSettings] = None) -> None:
         self.cacher = cacher
         self.settings = settings
-        self.headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.settings.get("token")}',
-            'cache-control': 'no-cache',
-        }
-
-        url_parts = self.settings.get('url').split('://')
-        url = '://'.join(url_parts[1:])
-        connection = HTTPSConnection if url_parts[0] == 'https' else HTTPConnection
+        self.assistant = assistant
+        self.backend = create_provider(settings=settings, assistant=assistant)
+        self.headers = self.backend.headers()
+        self.timeouts = load_timeouts(settings=settings, assistant=assistant)
 
         proxy_settings = self.settings.get('proxy')
-        if isinstance(proxy_settings, dict):
-            address = proxy_settings.get('address')
-            port = proxy_settings.get('port')
-            proxy_username = proxy_settings.get('username')
-            proxy_password = proxy_settings.get('password')
-            proxy_auth = b64encode(bytes(f'{proxy_username}:{proxy_password}', 'utf-8')).strip().decode('ascii')
-            headers = {'Proxy-Authorization': f'Basic {proxy_auth}'} if len(proxy_auth) > 0 else {}
-            if address and len(address) > 0 and port:
-                self.connection = connection(
-                    host=address,
-                    port=port,
-                )
-                self.connection.set_tunnel(
-                    url,
-                    headers=headers
-                )
-            else:
-                self.connection = connection(url)
-
-    def prepare_payload(self, assitant_setting: AssistantSettings, messages: List[Dict[str, str]]) -> str:
-        internal_messages = []
-        internal_messages.insert(0, {'role': 'system', 'content': assitant_setting.assistant_role})
-        if assitant_setting.prompt_mode == PromptMode.panel.value:
+        prewarmed_connection = ConnectionPrewarmer.take(key=self.backend.connection_key(proxy_settings))
+        # A prewarmed connection could have been dropped by a server or a proxy while idle.
+        self.prewarmed = prewarmed_connection is not None
+        self.connection = prewarmed_connection or self.backend.create_connection(proxy_settings=proxy_settings)
+
+    def prepare_payload(self, assitant_setting: AssistantSettings, messages: List[Dict[str, str]], with_history: bool = True, include_usage: bool = False) -> ChatPayload:
+        message_fragments = [serialize_message({'role': 'system', 'content': assitant_setting.assistant_role})]
+        if assitant_setting.prompt_mode == PromptMode.panel.value and with_history:
             ## FIXME: This is error prone and should be rewritten
             #  Messages shouldn't be written in cache and passing as an attribute, should use either one.
-            internal_messages += self.cacher.read_all()
-        internal_messages += messages
+            # History lines are already serialized the very same way, so they're passed through as is.
+            message_fragments += self.cacher.read_all_raw()
+        message_fragments += [serialize_message(message) for message in messages]
 
-        return json.dumps({
+        self.routing_decision = route_model(
+            assistant=assitant_setting,
+            prompt_tokens=estimate_tokens(sum(len(fragment) for fragment in message_fragments))
+        )
+        if assitant_setting.models:
+            record_metric(
+                'model_routed',
+                assistant=assitant_setting.name,
+                model=self.routing_decision.model,
+                estimated_tokens=self.routing_decision.estimated_tokens,
+                context_window=self.routing_decision.context_window,
+                overflow=self.routing_decision.overflow
+            )
+
+        parameters: Dict[str, Any] = {
             # Todo add uniq name for each output panel (e.g. each window)
-            'messages': internal_messages,
-            'model': assitant_setting.chat_model,
+            'model': self.routing_decision.model,
             'temperature': assitant_setting.temperature,
             'max_tokens': assitant_setting.max_tokens,
             'top_p': assitant_setting.top_p,
             'stream': True
-        })
+        }
+        if include_usage:
+            # The last chunk of a stream brings token usage then, with no choices in it.
+            parameters['stream_options'] = {'include_usage': True}
+        parameters_json = json.dumps(parameters)
+
+        # Messages go first and are kept byte to byte stable between turns, so a server side prompt cache hits.
+        fragments = [b'{"messages": [']
+        for index, fragment in enumerate(message_fragments):
+            if index > 0: fragments.append(b', ')
+            fragments.append(fragment)
+        fragments.append(b'], ' + parameters_json[1:].encode('utf-8'))
+        return ChatPayload(fragments)
+
+    def prepare_request(self, json_payload: ChatPayload):
+        self.payload = json_payload
+        self.deadline = time.monotonic() + self.timeouts['total']
+        try:
+            self.send_request_()
+        except (OSError, HTTPException):
+            if not self.prewarmed: raise
+            self.reconnect_()
+
+    def send_request_(self):
+        headers = {**self.headers, 'Content-Length': str(len(self.payload))}
+        self.arm_timeout('connect')
+        try:
+            self.connection.request(method='POST', url=self.backend.path, body=self.payload, headers=headers)
+        except socket.timeout:
+            raise self.timeout_error() from None
+        # A connection drops its socket once a response says it'd be closed, while it's still read through.
+        self.sock = self.connection.sock
 
-    def prepare_request(self, json_payload):
-        self.connection.request(method='POST', url='/v1/chat/completions', body=json_payload, headers=self.headers)
+    def reconnect_(self):
+        """Sends a request once again by a new connection, when a prewarmed one turned out to be dropped."""
+        self.connection.close()
+        self.prewarmed = False
+        self.sock = None
+        self.connection = self.backend.create_connection(proxy_settings=self.settings.get('proxy'))
+        self.send_request_()
 
     def execute_response(self) -> Optional[HTTPResponse]:
         return self._execute_network_request()
 
+    def iterate_response(self, response: HTTPResponse) -> Iterator[bytes]:
+        """Yields lines of a streamed response, each read is bounded by the `idle` timeout and the `total` deadline."""
+        lines = iter(response)
+        while True:
+            self.arm_timeout('idle')
+            try:
+                line = next(lines)
+            except StopIteration:
+                return
+            except socket.timeout:
+                raise self.timeout_error() from None
+            yield line
+
+    def arm_timeout(self, kind: str):
+        """Sets a socket timeout for the next blocking operation, which is never past the `total` deadline."""
+        remaining = self.deadline - time.monotonic()
+        timeout = self.timeouts[kind]
+        if remaining < timeout:
+            kind, timeout = 'total', max(remaining, 0.001)
+        self.timeout_kind = kind
+        # It's applied on connecting, and to a socket that's already there (e.g. a prewarmed one).
+        self.connection.timeout = timeout
+        sock = self.sock or self.connection.sock
+        if sock:
+            sock.settimeout(timeout)
+
+    def timeout_error(self) -> RequestTimeoutException:
+        kind = self.timeout_kind
+        record_metric(
+            'request_timeout',
+            kind=kind,
+            timeout=self.timeouts[kind],
+            assistant=self.assistant.name if self.assistant else None,
+            model=self.routing_decision.model if self.routing_decision else None
+        )
+        self.connection.close()
+        return TIMEOUT_ERRORS[kind](TIMEOUT_MESSAGES[kind].format(timeout=self.timeouts[kind]))
+
     def close_connection(self):
-        self.response.close()
+        if self.response:
+            self.response.close()
         self.connection.close()
 
     def _execute_network_request(self) -> Optional[HTTPResponse]:
-        self.response = self.connection.getresponse()
+        self.arm_timeout('first_byte')
+        try:
+            self.response = self.connection.getresponse()
+        except socket.timeout:
+            raise self.timeout_error() from None
+        except (OSError, HTTPException):
+            if not self.prewarmed: raise
+            self.reconnect_()
+            return self._execute_network_request()
         # handle 400-499 client errors and 500-599 server errors
         if 400 <= self.response.status < 600:
             error_object = self.response.read().decode('utf-8')
-            error_data = json.loads(error_object)
-            if error_data.get('error', {}).get('code') == 'context_length_exceeded':
-                raise ContextLengthExceededException(error_data['error']['message'])
-            raise UnknownException(error_data.get('error').get('message'))
+            raise self.backend.map_error(status=self.response.status, body=error_object)
         return self.response
@@ -1,4 +1,4 @@
-from .assistant_settings import AssistantSettings, DEFAULT_ASSISTANT_SETTINGS, CommandMode
+from .assistant_settings import AssistantSettings, DEFAULT_ASSISTANT_SETTINGS, CommandMode, PromptMode
 import sublime
 from sublime import View, Region
 from sublime_plugin import WindowCommand
@@ -7,6 +7,8 @@ import functools
 from typing import Optional, List
 from .cacher import Cacher
 from .openai_worker import OpenAIWorker
+from .openai_network_client import ConnectionPrewarmer
+from .inline_completion import InlineCompletionListener
 from threading import Event
 
 class OpenaiPanelCommand(WindowCommand):
@@ -38,6 +40,9 @@ class OpenaiPanelCommand(WindowCommand):
         OpenaiPanelCommand.worker_thread.start()
 
     def run(self):
+        # Connecting in advance, while a user picks an assistant and types a question.
+        last_assistant = Cacher().read_model()
+        ConnectionPrewarmer.warm_up(settings=self.settings, assistant=AssistantSettings(**{**DEFAULT_ASSISTANT_SETTINGS, **last_assistant}) if last_assistant else None)
         self.window.show_quick_panel([f"{assistant.name} | {assistant.prompt_mode} | {assistant.chat_model}" for assistant in self.assistants], self.on_done)
 
     def on_done(self, index: int):
@@ -46,6 +51,14 @@ class OpenaiPanelCommand(WindowCommand):
         assistant = self.assistants[index]
 
         Cacher().save_model(assistant.__dict__)
+        InlineCompletionListener.set_assistant(assistant)
+        # No-op if the picked assistant shares an endpoint with the previous one.
+        ConnectionPrewarmer.warm_up(settings=self.settings, assistant=assistant)
+
+        if assistant.prompt_mode == PromptMode.inline.value:
+            # There's nothing to ask, suggestions show up while typing from now on.
+            self.window.status_message(f"OpenAI: {assistant.name} suggests completions while typing")
+            return
 
         region: Optional[Region] = None
         text: Optional[str] = ""
@@ -1,11 +1,13 @@
 import sublime
 from sublime import View, Region
 from threading import Thread, Event
-from .cacher import Cacher
+from .cacher import Cacher, content_digest
 from typing import Dict, List, Optional, Any
 from .openai_network_client import NetworkClient
 from .buffer import TextStreamer
-from .errors.OpenAIException import ContextLengthExceededException, UnknownException, WrongUserInputException, present_error, present_unknown_error
+from .stream_guard import StreamStopDetector
+from .metrics import record_metric
+from .errors.OpenAIException import ConnectTimeoutException, ContextLengthExceededException, FirstByteTimeoutException, RequestTimeoutException, UnknownException, WrongUserInputException, present_error, present_unknown_error
 from .assistant_settings import AssistantSettings, DEFAULT_ASSISTANT_SETTINGS, PromptMode
 from json import JSONDecoder
 import re
@@ -30,7 +32,7 @@ class OpenAIWorker(Thread):
         assistant_dict = opt_assistant_dict if opt_assistant_dict else self.settings.get('assistants')[0]
         ## merging dicts with a default one and initializing AssitantSettings
         self.assistant = assistant if assistant is not None else AssistantSettings(**{**DEFAULT_ASSISTANT_SETTINGS, **assistant_dict})
-        self.provider = NetworkClient(settings=self.settings)
+        self.provider = NetworkClient(settings=self.settings, assistant=self.assistant)
         self.window = sublime.active_window()
 
         markdown_setting = self.settings.get('markdown')
@@ -40,7 +42,10 @@ class OpenAIWorker(Thread):
         from .output_panel import SharedOutputPanelListener # https://stackoverflow.com/a/52927102
         self.listner = SharedOutputPanelListener(markdown=markdown_setting)
 
+        self.timeout_retries_left = self.settings.get('timeout_retries', 1)
+
         self.buffer_manager = TextStreamer(self.view)
+        self.stop_detector = StreamStopDetector.from_assistant(self.assistant)
         super(OpenAIWorker, self).__init__()
 
     # This method appears redundant.
@@ -56,19 +61,22 @@ class OpenAIWorker(Thread):
     def update_completion(self, completion):
         self.buffer_manager.update_completion(completion=completion)
 
-    def handle_sse_delta(self, delta: Dict[str, Any], full_response_content:Dict[str, str]):
+    def handle_sse_delta(self, delta: Dict[str, Any], full_response_content: Dict[str, Any]):
         if self.assistant.prompt_mode == PromptMode.panel.name:
             if 'role' in delta:
                 full_response_content['role'] = delta['role']
             if 'content' in delta:
-                full_response_content['content'] += delta['content']
+                full_response_content['content'].append(delta['content'])
                 self.update_output_panel(delta['content'])
         else:
             if 'content' in delta:
-                self.update_completion(delta['content'])
+                completion = self.stop_detector.feed(delta['content']) if self.stop_detector.enabled else delta['content']
+                if completion:
+                    self.update_completion(completion)
 
     def prepare_to_response(self):
         if self.assistant.prompt_mode == PromptMode.panel.name:
+            self.listner.begin_stream(window=self.window)
             self.update_output_panel("\n\n## Answer\n\n")
             self.listner.show_panel(window=self.window)
             self.listner.scroll_to_botton(window=self.window)
@@ -119,36 +127,62 @@ class OpenAIWorker(Thread):
             raise
 
         # without key declaration it would failt to append there later in code.
-        full_response_content = {'role': '', 'content': ''}
-
-        for chunk in response:
-
-            # FIXME: With this behavior a bit of latest tokens get missed. (e.g. the're seen within a proxy, but not in the code)
-            if self.stop_event.is_set():
-                self.handle_sse_delta(delta={'role': "assistant"}, full_response_content=full_response_content)
-                self.handle_sse_delta(delta={'content': "\n\n[Aborted]"}, full_response_content=full_response_content)
+        # Content is collected as chunks and joined once the stream is over.
+        full_response_content: Dict[str, Any] = {'role': '', 'content': []}
 
-                self.provider.close_connection()
-                break
-            chunk_str = chunk.decode('utf-8')
+        try:
+            for chunk in self.provider.iterate_response(response):
 
-            # Check for SSE data
-            if chunk_str.startswith("data:") and not re.search(r"\[DONE\]$", chunk_str):
-                chunk_str = chunk_str[len("data:"):].strip()
+                # FIXME: With this behavior a bit of latest tokens get missed. (e.g. the're seen within a proxy, but not in the code)
+                if self.stop_event.is_set():
+                    self.handle_sse_delta(delta={'role': "assistant"}, full_response_content=full_response_content)
+                    self.handle_sse_delta(delta={'content': "\n\n[Aborted]"}, full_response_content=full_response_content)
 
-                try:
-                    response = JSONDecoder().decode(chunk_str)
-                    if 'delta' in response['choices'][0]:
-                        delta = response['choices'][0]['delta']
-                        self.handle_sse_delta(delta=delta, full_response_content=full_response_content)
-                except:
-                    response.close()
                     self.provider.close_connection()
-                    raise
+                    break
+                chunk_str = chunk.decode('utf-8')
+
+                # Check for SSE data
+                if chunk_str.startswith("data:") and not re.search(r"\[DONE\]$", chunk_str):
+                    chunk_str = chunk_str[len("data:"):].strip()
+
+                    try:
+                        response = JSONDecoder().decode(chunk_str)
+                        if 'delta' in response['choices'][0]:
+                            delta = response['choices'][0]['delta']
+                            self.handle_sse_delta(delta=delta, full_response_content=full_response_content)
+                    except:
+                        response.close()
+                        self.provider.close_connection()
+                        raise
+
+                    # Everything that's wanted has been received, the rest of the answer isn't worth waiting (and paying) for.
+                    if self.stop_detector.stopped:
+                        record_metric('stream_stopped_early', assistant=self.assistant.name, prompt_mode=self.assistant.prompt_mode)
+                        break
+        except RequestTimeoutException:
+            # The partial answer is kept, so the history still alternates between questions and answers.
+            if self.assistant.prompt_mode == PromptMode.panel.name:
+                self.handle_sse_delta(delta={'role': "assistant", 'content': "\n\n[Timed out]"}, full_response_content=full_response_content)
+                self.store_answer(full_response_content=full_response_content)
+            raise
 
         self.provider.close_connection()
+        if self.assistant.prompt_mode != PromptMode.panel.name and self.stop_detector.enabled:
+            remainder = self.stop_detector.flush()
+            if remainder:
+                self.update_completion(remainder)
         if self.assistant.prompt_mode == PromptMode.panel.name:
-            Cacher().append_to_cache([full_response_content])
+            self.store_answer(full_response_content=full_response_content)
+
+    def store_answer(self, full_response_content: Dict[str, Any]):
+        Cacher().append_to_cache([{'role': full_response_content['role'], 'content': ''.join(full_response_content['content'])}])
+        self.archive_history_overflow()
+
+    def archive_history_overflow(self):
+        retention = self.settings.get('chat_history_retention', 0)
+        if not isinstance(retention, int) or retention <= 0: return
+        Cacher().archive_overflow(retention=retention, segment_size_kb=self.settings.get('chat_history_archive_segment_kb', 512))
 
     def handle_response(self):
         try:
@@ -158,26 +192,61 @@ class OpenAIWorker(Thread):
             if do_delete:
                 Cacher().drop_first(2)
                 messages = self.create_message(selected_text=self.text, command=self.command)
-                payload = self.provider.prepare_payload(assitant_setting=self.assistant, messages=messages)
-                self.provider.prepare_request(json_payload=payload)
+                self.payload = self.provider.prepare_payload(assitant_setting=self.assistant, messages=messages)
+                try:
+                    self.send_request()
+                except RequestTimeoutException as error:
+                    present_error(title="OpenAI error", error=error)
+                    return
                 self.handle_response()
         except WrongUserInputException as error:
             present_error(title="OpenAI error", error=error)
             return
+        except FirstByteTimeoutException as error:
+            # Nothing has been received yet, so it's safe to send the very same request once again.
+            if self.timeout_retries_left <= 0:
+                present_error(title="OpenAI error", error=error)
+                return
+            self.timeout_retries_left -= 1
+            self.provider = NetworkClient(settings=self.settings, assistant=self.assistant)
+            try:
+                self.send_request()
+            except RequestTimeoutException as error:
+                present_error(title="OpenAI error", error=error)
+                return
+            self.handle_response()
+        except RequestTimeoutException as error:
+            # A part of an answer is already there, sending a request again would duplicate it.
+            present_error(title="OpenAI error", error=error)
+            return
         except UnknownException as error:
             present_error(title="OpenAI error", error=error)
             return
 
+    def send_request(self):
+        """Sends the payload, on a connect timeout it's sent again by a new connection while `timeout_retries` allows."""
+        while True:
+            try:
+                self.provider.prepare_request(json_payload=self.payload)
+                return
+            except ConnectTimeoutException:
+                if self.timeout_retries_left <= 0: raise
+                self.timeout_retries_left -= 1
+                self.provider = NetworkClient(settings=self.settings, assistant=self.assistant)
+
     def manage_chat_completion(self):
         wrapped_selection = None
         if self.region:
             scope = self.window.active_view().scope_name(self.region.begin())
             scope_name = scope.split('.')[-1]
             wrapped_selection = f"```{scope_name}\n" + self.text + "\n```"
+            if self.assistant.prompt_mode == PromptMode.panel.name:
+                wrapped_selection = self.deduplicate_selection(wrapped_selection=wrapped_selection, scope_name=scope_name)
 
         messages = self.create_message(selected_text=wrapped_selection, command=self.command, placeholder=self.assistant.placeholder)
         ## FIXME: This should be here, otherwise it would duplicates the messages.
-        payload = self.provider.prepare_payload(assitant_setting=self.assistant, messages=messages)
+        self.payload = self.provider.prepare_payload(assitant_setting=self.assistant, messages=messages)
+        self.present_routing_decision()
 
         if self.assistant.prompt_mode == PromptMode.panel.name:
             cacher = Cacher()
@@ -198,11 +267,38 @@ class OpenAIWorker(Thread):
             # convenience is in being able see current selection while writting additional input to an assistant by input panel.
             self.view.sel().clear()
         try:
-            self.provider.prepare_request(json_payload=payload)
+            self.send_request()
+        except RequestTimeoutException as error:
+            present_error(title="OpenAI error", error=error)
+            return
         except Exception as error:
             present_unknown_error(title="OpenAI error", error=error)
             return
-        self.handle_response()
+        try:
+            self.handle_response()
+        finally:
+            if self.assistant.prompt_mode == PromptMode.panel.name:
+                self.listner.end_stream(window=self.window)
+
+    def present_routing_decision(self):
+        decision = self.provider.routing_decision
+        if not self.assistant.models or not decision:
+            # A route of a previous request would be misleading for this one.
+            self.view.erase_status('openai_model_route')
+            return
+        overflow_hint = ', exceeds every context window' if decision.overflow else ''
+        self.view.set_status('openai_model_route', f'[{decision.model} | ~{decision.estimated_tokens} tokens{overflow_hint}]')
+
+    def deduplicate_selection(self, wrapped_selection: str, scope_name: str) -> str:
+        """Refers back to a selection that has already been sent within this conversation instead of repeating it."""
+        if not self.settings.get('deduplicate_selections', True): return wrapped_selection
+        if content_digest(wrapped_selection) not in Cacher().content_digests(): return wrapped_selection
+
+        first_line = self.text.strip().split('\n')[0]
+        reference = f"The selected {scope_name} code is unchanged since I've sent it earlier in this conversation (the one starting with `{first_line}`)."
+        # The original could be archived or dropped later on, while the reference still stays.
+        Cacher().remember_reference(reference=reference, original=wrapped_selection)
+        return reference
 
     def create_message(self, selected_text: Optional[str], command: Optional[str], placeholder: Optional[str] = None) -> List[Dict[str, str]]:
         messages = []
@@ -216,11 +312,13 @@ class OpenAIWorker(Thread):
             # FIXME: It's better to have such check locally, but it's pretty complicated with all those different modes and models
             # if (self.settings.get("max_tokens") + len(self.text)) > 4000:
             #     raise AssertionError("OpenAI accepts max. 4000 tokens, so the selected text and the max_tokens setting must be lower than 4000.")
-            api_token = self.settings.get('token')
-            if not isinstance(api_token, str):
-                raise WrongUserInputException("The token must be a string.")
-            if len(api_token) < 10:
-                raise WrongUserInputException("No API token provided, you have to set the OpenAI token into the settings to make things work.")
+            api_token = self.provider.backend.token
+            # Local servers don't need any token at all.
+            if self.provider.backend.requires_token:
+                if not isinstance(api_token, str):
+                    raise WrongUserInputException("The token must be a string.")
+                if len(api_token) < 10:
+                    raise WrongUserInputException("No API token provided, you have to set the OpenAI token into the settings to make things work.")
         except WrongUserInputException as error:
             present_error(title="OpenAI error", error=error)
             return
@@ -1,10 +1,34 @@
-from sublime import Window, View, load_settings
+from sublime import LAYOUT_BLOCK, Phantom, PhantomSet, Region, Window, View, load_settings, set_timeout
 from sublime_plugin import EventListener
 from .cacher import Cacher
-from typing import Optional
+from typing import Dict, List, Optional
+import functools
+import html
+import time
+
+MARKDOWN_SYNTAX = "Packages/Markdown/MultiMarkdown.sublime-syntax"
+# Seconds between refreshes of a phantom with an answer being streamed.
+PHANTOM_REFRESH_INTERVAL = 0.1
+TRIMMED_CONTENT_MARKER = "> Earlier messages are hidden to keep this view responsive, they're still in the chat history.\n"
+
+def message_header(message: Dict[str, str]) -> str:
+    ## TODO: Make me enumerated (it's not that easy, since question and answer are the different lines)
+    if message['role'] == 'user':
+        return '\n\n## Question\n\n'
+    elif message['role'] == 'assistant':
+        return '\n\n## Answer\n\n'
+    return ''
+
 
 class SharedOutputPanelListener(EventListener):
     OUTPUT_PANEL_NAME = "OpenAI Chat"
+    # Text of answers being streamed, per view. It's shown by a plain text phantom and appended to the view
+    # (so lexed as markdown) at once, when the stream is over or stalls.
+    pending_texts: Dict[int, List[str]] = {}
+    # Counts chunks per streaming view to tell whether it went idle since a flush has been scheduled.
+    append_counters: Dict[int, int] = {}
+    phantom_sets: Dict[int, PhantomSet] = {}
+    phantom_refreshed_at: Dict[int, float] = {}
 
     def __init__(self, markdown: bool = True, cacher: Cacher = Cacher()) -> None:
         self.markdown: bool = markdown
@@ -39,7 +63,51 @@ class SharedOutputPanelListener(EventListener):
         return output_panel
 
     def setup_presentation_style_(self, view: View):
-        if self.markdown: view.set_syntax_file("Packages/Markdown/MultiMarkdown.sublime-syntax")
+        self.set_syntax_(view=view, syntax=MARKDOWN_SYNTAX)
+
+    def set_syntax_(self, view: View, syntax: str):
+        # Setting the very same syntax again still makes the whole view to be lexed again.
+        if self.markdown and view.settings().get('syntax') != syntax:
+            view.set_syntax_file(syntax)
+
+    def begin_stream(self, window: Window):
+        """Holds an answer being streamed out of a view, so the view isn't lexed as markdown on every chunk."""
+        if not self.markdown or not self.settings.get('deferred_markdown_highlighting', True): return
+        view = self.get_output_view_(window=window)
+        self.pending_texts[view.id()] = []
+        self.append_counters[view.id()] = 0
+
+    def end_stream(self, window: Window):
+        view = self.get_output_view_(window=window)
+        self.flush_pending_text_(view=view)
+        self.pending_texts.pop(view.id(), None)
+        self.append_counters.pop(view.id(), None)
+        self.phantom_refreshed_at.pop(view.id(), None)
+
+    def flush_if_idle_(self, view: View, append_counter: int):
+        # The stream has stalled, so what's there so far gets highlighted.
+        if self.append_counters.get(view.id()) == append_counter:
+            self.flush_pending_text_(view=view)
+
+    def flush_pending_text_(self, view: View):
+        pending_text = self.pending_texts.get(view.id())
+        if not pending_text: return
+        text = ''.join(pending_text)
+        pending_text.clear()
+        phantom_set = self.phantom_sets.get(view.id())
+        if phantom_set:
+            phantom_set.update([])
+        self.append_to_view_(view=view, text=text)
+
+    def show_pending_text_(self, view: View):
+        # Rendering a phantom costs as much as the text in it, so it's refreshed a few times per second at most.
+        now = time.time()
+        if now - self.phantom_refreshed_at.get(view.id(), 0) < PHANTOM_REFRESH_INTERVAL: return
+        self.phantom_refreshed_at[view.id()] = now
+
+        content = html.escape(''.join(self.pending_texts[view.id()])).replace('\n', '<br>').replace(' ', '&nbsp;')
+        phantom_set = self.phantom_sets.setdefault(view.id(), PhantomSet(view, 'openai_streaming_answer'))
+        phantom_set.update([Phantom(Region(view.size()), f'<body id="openai-streaming-answer">{content}</body>', LAYOUT_BLOCK)])
 
     def toggle_overscroll(self, window: Window, enabled: bool):
         view = self.get_output_view_(window=window)
@@ -47,10 +115,40 @@ class SharedOutputPanelListener(EventListener):
 
     def update_output_view(self, text: str, window: Window):
         view = self.get_output_view_(window=window)
+        if view.id() not in self.pending_texts:
+            self.append_to_view_(view=view, text=text)
+            return
+
+        self.pending_texts[view.id()].append(text)
+        self.append_counters[view.id()] += 1
+        self.show_pending_text_(view=view)
+        set_timeout(
+            functools.partial(self.flush_if_idle_, view, self.append_counters[view.id()]),
+            self.settings.get('markdown_highlight_idle_ms', 1000)
+        )
+
+    def append_to_view_(self, view: View, text: str):
         view.set_read_only(False)
         view.run_command('append', {'characters': text})
+        self.trim_output_view_(view=view)
         view.set_read_only(True)
 
+    def max_output_size_(self) -> int:
+        max_size = self.settings.get('output_panel_max_chars', 0)
+        return max_size if isinstance(max_size, int) and max_size > 0 else 0
+
+    def trim_output_view_(self, view: View):
+        """Erases the oldest content once the view exceeds `output_panel_max_chars`, it's still there in the history.
+
+        It trims down to 80% of the limit so it doesn't happen on every chunk appended.
+        """
+        max_size = self.max_output_size_()
+        if not max_size or view.size() <= max_size: return
+
+        cut_point = min(view.line(view.size() - int(max_size * 0.8)).end() + 1, view.size())
+        view.run_command("erase_region", {"region": {'a': 0, 'b': cut_point}})
+        view.run_command("text_stream_at", {"position": 0, "text": TRIMMED_CONTENT_MARKER})
+
     def get_output_view_(self, window: Window) -> View:
         view = self.get_tab_(window=window) or self.get_output_panel_(window=window)
         self.setup_presentation_style_(view=view)
@@ -61,18 +159,30 @@ class SharedOutputPanelListener(EventListener):
         output_panel.set_read_only(False)
         self.clear_output_panel(window)
 
-        for line in self.cacher.read_all():
-            ## TODO: Make me enumerated (it's not that easy, since question and answer are the different lines)
-            if line['role'] == 'user':
-                output_panel.run_command('append', {'characters': f'\n\n## Question\n\n'})
-            elif line['role'] == 'assistant':
-                output_panel.run_command('append', {'characters': '\n\n## Answer\n\n'})
+        messages = self.cacher.read_all()
+        first_rendered = self.first_rendered_message_(messages)
+        rendered: List[str] = [TRIMMED_CONTENT_MARKER] if first_rendered > 0 else []
+        for line in messages[first_rendered:]:
+            rendered.append(message_header(line))
+            rendered.append(line['content'])
 
-            output_panel.run_command('append', {'characters': line['content']})
+        output_panel.run_command('append', {'characters': ''.join(rendered)})
 
         output_panel.set_read_only(True)
         self.scroll_to_botton(window=window)
 
+    def first_rendered_message_(self, messages: List[Dict[str, str]]) -> int:
+        """Index of the oldest message that's rendered, counting from the most recent one until the size limit is reached."""
+        max_size = self.max_output_size_()
+        if not max_size: return 0
+
+        rendered_size = 0
+        for index in range(len(messages) - 1, -1, -1):
+            rendered_size += len(message_header(messages[index])) + len(messages[index]['content'])
+            if rendered_size > max_size and index < len(messages) - 1:
+                return index + 1
+        return 0
+
     def clear_output_panel(self, window):
         output_panel = self.get_output_view_(window=window)
         output_panel.run_command("select_all")
@@ -82,9 +192,8 @@ class SharedOutputPanelListener(EventListener):
     ## despite that textpoint provides correct value.
     def scroll_to_botton(self, window):
         output_panel = self.get_output_view_(window=window)
-        point = output_panel.text_point(__get_number_of_lines__(view=output_panel), 0)
-        print(f"point: {point}")
-        output_panel.show_at_center(point)
+        # The end of a view is its size, there's no need to walk through all its lines.
+        output_panel.show_at_center(output_panel.size())
 
     def get_active_tab_(self, window) -> Optional[View]:
         if self.settings.get(f'streaming_view_id_for_window_{window.id()}', None) is not None:
@@ -101,7 +210,3 @@ class SharedOutputPanelListener(EventListener):
             return
 
         window.run_command("show_panel", {"panel": f"output.{self.OUTPUT_PANEL_NAME}"})
-
-def __get_number_of_lines__(view: View) -> int:
-        last_line_num = view.rowcol(view.size())[0]
-        return last_line_num
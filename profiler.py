@@ -0,0 +1,134 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sublime_plugin import WindowCommand
+
+from .buffer import EraseRegionCommand, TextStreamAtCommand
+from .cacher import Cacher
+from .inline_completion import InlineCompletionListener
+from .openai import ActiveViewEventListener
+from .openai_worker import OpenAIWorker
+from .output_panel import SharedOutputPanelListener
+
+# Worker thread entry point and plugin callbacks that run on the UI thread.
+PROFILED_CALLABLES: List[Tuple[type, str]] = [
+    (OpenAIWorker, 'run'),
+    (SharedOutputPanelListener, 'update_output_view'),
+    (SharedOutputPanelListener, 'refresh_output_panel'),
+    (TextStreamAtCommand, 'run'),
+    (EraseRegionCommand, 'run'),
+    (ActiveViewEventListener, 'on_activated'),
+    (InlineCompletionListener, 'on_modified_async'),
+    (InlineCompletionListener, 'show_suggestion'),
+    (Cacher, 'append_to_cache'),
+]
+
+
+class Profiler():
+    """Profiles plugin code with cProfile on demand.
+
+    Profiled methods are swapped with wrappers only while profiling is on
+    and the originals are put back once it's off, so there's no overhead otherwise.
+    Every thread gets its own profile, they're merged on stop.
+    """
+    originals: Dict[Tuple[type, str], Callable] = {}
+    profiles: List[cProfile.Profile] = []
+    lock = threading.Lock()
+    local = threading.local()
+    started_at: Optional[float] = None
+
+    @classmethod
+    def is_running(cls) -> bool:
+        return cls.started_at is not None
+
+    @classmethod
+    def start(cls):
+        cls.profiles = []
+        cls.local = threading.local()
+        for owner, name in PROFILED_CALLABLES:
+            original = owner.__dict__[name]
+            cls.originals[(owner, name)] = original
+            setattr(owner, name, cls.wrap(original))
+        cls.started_at = time.time()
+
+    @classmethod
+    def stop(cls) -> Optional[pstats.Stats]:
+        for (owner, name), original in cls.originals.items():
+            setattr(owner, name, original)
+        cls.originals = {}
+        cls.started_at = None
+
+        with cls.lock:
+            profiles, cls.profiles = cls.profiles, []
+        stats: Optional[pstats.Stats] = None
+        for profile in profiles:
+            try:
+                stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+            except TypeError:
+                # A profile that hasn't recorded a single call.
+                continue
+        return stats
+
+    @classmethod
+    def wrap(cls, original: Callable) -> Callable:
+        @functools.wraps(original)
+        def wrapper(*args: Any, **kwargs: Any):
+            local = cls.local
+            # Nested profiled calls are already covered by the outer one.
+            if getattr(local, 'depth', 0) > 0:
+                return original(*args, **kwargs)
+
+            profile = getattr(local, 'profile', None)
+            if profile is None:
+                profile = cProfile.Profile()
+                local.profile = profile
+                with cls.lock:
+                    cls.profiles.append(profile)
+
+            local.depth = 1
+            profile.enable()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                profile.disable()
+                local.depth = 0
+        return wrapper
+
+
+class OpenaiToggleProfilerCommand(WindowCommand):
+    def run(self):
+        if not Profiler.is_running():
+            Profiler.start()
+            self.window.status_message("OpenAI: Profiling started, run the command again to stop it")
+            return
+
+        duration = time.time() - (Profiler.started_at or time.time())
+        stats = Profiler.stop()
+        if stats is None:
+            self.window.status_message("OpenAI: Profiling stopped, nothing was recorded")
+            return
+
+        cacher = Cacher()
+        os.makedirs(cacher.profiles_dir, exist_ok=True)
+        profile_file = os.path.join(cacher.profiles_dir, f"profile_{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+        stats.dump_stats(profile_file)
+
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(30)
+        stats.sort_stats('tottime').print_stats(20)
+
+        view = self.window.new_file()
+        view.set_scratch(True)
+        view.set_name("OpenAI: Profile")
+        view.run_command('append', {'characters': f"Profiled for {duration:.1f}s, stats saved to {profile_file}\n{summary.getvalue()}"})
+        view.set_read_only(True)
+
+    def is_checked(self) -> bool:
+        return Profiler.is_running()
@@ -0,0 +1,151 @@
+import json
+import re
+import socket
+from base64 import b64encode
+from http.client import HTTPConnection, HTTPSConnection
+from typing import Any, Dict, Optional, Type
+
+import sublime
+
+from .assistant_settings import AssistantSettings
+from .errors.OpenAIException import ContextLengthExceededException, OpenAIException, UnknownException
+
+UNIX_SOCKET_SCHEME = 'unix'
+
+
+class UnixSocketConnection(HTTPConnection):
+    """Plain HTTP over a Unix domain socket, e.g. `unix:///run/ollama.sock`."""
+
+    def __init__(self, socket_path: str, timeout: Any = socket._GLOBAL_DEFAULT_TIMEOUT) -> None:
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class Provider():
+    """Endpoint, auth and error shape of an OpenAI compatible chat completions API.
+
+    Everything else (payload, SSE streaming and its handling) is the same for every provider.
+    """
+    name = 'openai'
+    default_path = '/v1/chat/completions'
+    requires_token = True
+
+    def __init__(self, url: str, token: Optional[str], api_path: Optional[str] = None, auth_scheme: Optional[str] = None) -> None:
+        self.url = url
+        self.token = token
+        self.path = api_path or self.default_path
+        self.auth_scheme = auth_scheme or 'bearer'
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            'Content-Type': 'application/json',
+            'cache-control': 'no-cache',
+        }
+        if self.token and self.auth_scheme == 'bearer':
+            headers['Authorization'] = f'Bearer {self.token}'
+        elif self.token and self.auth_scheme == 'api-key':
+            headers['api-key'] = self.token
+        return headers
+
+    def connection_key(self, proxy_settings: Any) -> str:
+        return json.dumps([self.url, proxy_settings], sort_keys=True)
+
+    def create_connection(self, proxy_settings: Any) -> HTTPConnection:
+        url_parts = self.url.split('://')
+        url = '://'.join(url_parts[1:])
+        if url_parts[0] == UNIX_SOCKET_SCHEME:
+            return UnixSocketConnection(socket_path=url)
+
+        connection = HTTPSConnection if url_parts[0] == 'https' else HTTPConnection
+
+        if isinstance(proxy_settings, dict):
+            address = proxy_settings.get('address')
+            port = proxy_settings.get('port')
+            proxy_username = proxy_settings.get('username')
+            proxy_password = proxy_settings.get('password')
+            proxy_auth = b64encode(bytes(f'{proxy_username}:{proxy_password}', 'utf-8')).strip().decode('ascii')
+            headers = {'Proxy-Authorization': f'Basic {proxy_auth}'} if len(proxy_auth) > 0 else {}
+            if address and len(address) > 0 and port:
+                proxied_connection = connection(
+                    host=address,
+                    port=port,
+                )
+                proxied_connection.set_tunnel(
+                    url,
+                    headers=headers
+                )
+                return proxied_connection
+        return connection(url)
+
+    def map_error(self, status: int, body: str) -> OpenAIException:
+        try:
+            error_data = json.loads(body)
+        except json.JSONDecodeError:
+            return UnknownException(f'{status}: {body}')
+
+        error = error_data.get('error') if isinstance(error_data, dict) else None
+        if not isinstance(error, dict):
+            return UnknownException(f'{status}: {body}')
+        if error.get('code') == 'context_length_exceeded':
+            return ContextLengthExceededException(error['message'])
+        return UnknownException(error.get('message', body))
+
+
+class OpenAIProvider(Provider): ...
+
+
+class LocalProvider(Provider):
+    """Local OpenAI compatible servers, like llama.cpp or Ollama, over HTTP or a Unix socket.
+
+    A token isn't required, but it's passed along if there's one.
+    """
+    name = 'local'
+    requires_token = False
+
+    def map_error(self, status: int, body: str) -> OpenAIException:
+        try:
+            error_data = json.loads(body)
+        except json.JSONDecodeError:
+            error_data = None
+        error = error_data.get('error', body) if isinstance(error_data, dict) else body
+
+        # Ollama reports a plain string, llama.cpp an object with a type.
+        message = error.get('message', body) if isinstance(error, dict) else str(error)
+        error_type = error.get('type', '') if isinstance(error, dict) else ''
+        if error_type == 'exceed_context_size_error' or re.search(r'context (length|size|window)', message, re.IGNORECASE):
+            return ContextLengthExceededException(message)
+        return UnknownException(f'{status}: {message}')
+
+
+PROVIDERS: Dict[str, Type[Provider]] = {
+    OpenAIProvider.name: OpenAIProvider,
+    LocalProvider.name: LocalProvider,
+}
+
+
+def create_provider(settings: sublime.Settings, assistant: Optional[AssistantSettings] = None) -> Provider:
+    """Assistant properties take precedence over the global ones.
+
+    The global token is never passed to an assistant's own endpoint, it'd leak to another host otherwise.
+    """
+    def setting(key: str) -> Any:
+        value = getattr(assistant, key, None) if assistant else None
+        return value if value is not None else settings.get(key)
+
+    own_endpoint = assistant is not None and any(
+        getattr(assistant, key) is not None and getattr(assistant, key) != settings.get(key)
+        for key in ('url', 'provider')
+    )
+    provider_type = PROVIDERS.get(setting('provider') or OpenAIProvider.name, OpenAIProvider)
+    return provider_type(
+        url=setting('url'),
+        token=assistant.token if own_endpoint else setting('token'),
+        api_path=setting('api_path'),
+        auth_scheme=setting('auth_scheme'),
+    )
@@ -0,0 +1,111 @@
+import functools
+from typing import Dict, Iterable, List, Optional
+
+import sublime
+from sublime import Window
+from sublime_plugin import WindowCommand
+
+from .cacher import Cacher
+
+
+def exchange_of(messages: Iterable[Dict[str, str]], line: int) -> List[Dict[str, str]]:
+    """Messages of the exchange the given line belongs to."""
+    exchange: List[Dict[str, str]] = []
+    previous: Optional[Dict[str, str]] = None
+    for number, message in enumerate(messages):
+        # An exchange begins with the first question after an answer.
+        if previous and previous['role'] == 'assistant' and message['role'] == 'user':
+            if number > line: break
+            exchange = []
+        exchange.append(message)
+        previous = message
+    return exchange
+
+
+class OpenaiSearchHistoryCommand(WindowCommand):
+    def run(self):
+        self.window.show_input_panel("Search chat history: ", "", self.on_query, None, None)
+
+    def on_query(self, query: str):
+        # Rebuilding an index reads every archive segment, so it's kept away from the UI thread.
+        sublime.set_timeout_async(functools.partial(self.search, query), 0)
+
+    def search(self, query: str):
+        cacher = Cacher()
+        if not cacher.history_index.exists():
+            self.window.status_message("OpenAI: Indexing chat history...")
+            cacher.rebuild_history_index()
+
+        results = cacher.history_index.search(query)
+        if not results:
+            self.window.status_message(f"OpenAI: Nothing found for '{query}'")
+            return
+
+        items: List[List[str]] = []
+        for seq, role, preview in results:
+            location = cacher.history_index.locate(seq)
+            source = f"archive {location[0]}" if location and location[0] else "active history"
+            items.append([preview, f"{role.title()} | {source}"])
+
+        sublime.set_timeout(functools.partial(self.window.show_quick_panel, items, functools.partial(self.on_done, [seq for seq, _, _ in results])), 0)
+
+    def on_done(self, seqs: List[int], index: int):
+        if index == -1: return
+
+        cacher = Cacher()
+        location = cacher.history_index.locate(seqs[index])
+        if location is None: return
+
+        segment, line = location
+        if segment:
+            self.open_archived_exchange(window=self.window, cacher=cacher, segment=segment, line=line)
+        else:
+            self.jump_to_active_message(window=self.window, cacher=cacher, line=line)
+
+    def jump_to_active_message(self, window: Window, cacher: Cacher, line: int):
+        from .output_panel import SharedOutputPanelListener # https://stackoverflow.com/a/52927102
+
+        messages = cacher.read_all()
+        if line >= len(messages): return
+
+        listner = SharedOutputPanelListener(markdown=sublime.load_settings("openAI.sublime-settings").get('markdown'))
+        first_rendered = listner.first_rendered_message_(messages)
+        if line < first_rendered:
+            # It's hidden from the chat view by `output_panel_max_chars`.
+            self.show_exchange(window=window, name="chat history", exchange=exchange_of(messages, line))
+            return
+
+        first_line = messages[line]['content'].strip().split('\n')[0]
+        # The same text could be repeated across the history, so picking the occurrence with the matching ordinal
+        # among the messages that are actually rendered.
+        occurrence = sum(1 for message in messages[first_rendered:line] if first_line in message['content'])
+
+        listner.refresh_output_panel(window=window)
+        listner.show_panel(window=window)
+
+        view = listner.get_output_view_(window=window)
+        regions = view.find_all(first_line, sublime.LITERAL)
+        if not regions: return
+        region = regions[min(occurrence, len(regions) - 1)]
+        view.sel().clear()
+        view.sel().add(region)
+        view.show_at_center(region)
+
+    def open_archived_exchange(self, window: Window, cacher: Cacher, segment: str, line: int):
+        segment_path = next((path for path in cacher.archive_segments() if path.endswith(segment)), None)
+        if not segment_path: return
+
+        self.show_exchange(window=window, name=segment, exchange=exchange_of(cacher.read_segment(segment_path), line))
+
+    def show_exchange(self, window: Window, name: str, exchange: List[Dict[str, str]]):
+        view = window.new_file()
+        view.set_scratch(True)
+        view.set_name(f"OpenAI: {name}")
+        view.set_syntax_file("Packages/Markdown/MultiMarkdown.sublime-syntax")
+        for message in exchange:
+            if message['role'] == 'user':
+                view.run_command('append', {'characters': '\n\n## Question\n\n'})
+            elif message['role'] == 'assistant':
+                view.run_command('append', {'characters': '\n\n## Answer\n\n'})
+            view.run_command('append', {'characters': message['content']})
+        view.set_read_only(True)
@@ -1,10 +1,17 @@
 from .openai import Openai
 from .openai_panel import OpenaiPanelCommand
+from .batch_runner import OpenaiBatchCommand
+from .compare_assistants import OpenaiCompareAssistantsCommand
 from sublime_plugin import TextCommand
 
 class StopOpenaiExecutionCommand(TextCommand):
     def run(self, edit):
-        if Openai.worker_thread:
+        # Finished workers stay referenced, so only the alive ones count, and every one of them is stopped.
+        if Openai.worker_thread is not None and Openai.worker_thread.is_alive():
             Openai.stop_event.set()
-        elif OpenaiPanelCommand.worker_thread:
+        if OpenaiPanelCommand.worker_thread is not None and OpenaiPanelCommand.worker_thread.is_alive():
             OpenaiPanelCommand.stop_event.set()
+        if OpenaiBatchCommand.runner is not None and OpenaiBatchCommand.runner.is_alive():
+            OpenaiBatchCommand.stop_event.set()
+        if OpenaiCompareAssistantsCommand.is_running():
+            OpenaiCompareAssistantsCommand.stop_event.set()
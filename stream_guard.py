@@ -0,0 +1,104 @@
+import re
+from typing import List, Optional
+
+from .assistant_settings import AssistantSettings
+
+CODE_FENCE = '```'
+
+
+def strip_code_fence(text: str) -> str:
+    """Strips a fence around a whole completion, models tend to wrap code into one even when asked not to."""
+    lines = text.split('\n')
+    if lines and lines[0].startswith(CODE_FENCE):
+        lines = lines[1:]
+        # A closing fence could be followed by a line break.
+        while lines and not lines[-1].strip():
+            lines = lines[:-1]
+        if lines and lines[-1].strip() == CODE_FENCE:
+            lines = lines[:-1]
+    return '\n'.join(lines)
+
+
+class StreamStopDetector():
+    """Decides when a streamed completion has given everything that's wanted from it.
+
+    Text is passed through line by line, so fence markers could be stripped and patterns matched
+    against whole lines. It stops on the end of the first fenced code block, on any of `stop_patterns`
+    or once `max_lines` lines have been emitted, whichever comes first.
+
+    With `stop_at_code_block_end` lines are held until the first fence, so the prose before it
+    (e.g. "Here is the fixed code:") is dropped. An answer without any fence is passed through whole once it's over.
+    """
+
+    def __init__(self, stop_at_code_block_end: bool = False, stop_patterns: Optional[List[str]] = None, max_lines: Optional[int] = None) -> None:
+        self.stop_at_code_block_end = stop_at_code_block_end
+        self.stop_patterns = [re.compile(pattern) for pattern in stop_patterns or []]
+        self.max_lines = max_lines
+        self.stopped = False
+        self.in_code_block = False
+        self.emitted_lines = 0
+        self.pending = ''
+        self.held: List[str] = []
+
+    @classmethod
+    def from_assistant(cls, assistant: AssistantSettings) -> 'StreamStopDetector':
+        return cls(
+            stop_at_code_block_end=assistant.stop_at_code_block_end,
+            stop_patterns=assistant.stop_patterns,
+            max_lines=assistant.max_lines
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.stop_at_code_block_end or bool(self.stop_patterns) or bool(self.max_lines)
+
+    def feed(self, text: str) -> str:
+        """Returns the part of a text that should be emitted so far."""
+        if self.stopped: return ''
+
+        self.pending += text
+        output: List[str] = []
+        while '\n' in self.pending and not self.stopped:
+            line, self.pending = self.pending.split('\n', 1)
+            output.append(self.process_line(line + '\n'))
+        return ''.join(output)
+
+    def flush(self) -> str:
+        """Returns the last incomplete line, and the held lines if there's been no code block, once a stream is over."""
+        if self.stopped: return ''
+        line, self.pending = self.pending, ''
+        output = [self.process_line(line)] if line else []
+
+        held, self.held = self.held, []
+        for held_line in held:
+            if self.stopped: break
+            output.append(self.emit_line(held_line))
+        return ''.join(output)
+
+    def process_line(self, line: str) -> str:
+        if self.stop_at_code_block_end and line.strip().startswith(CODE_FENCE):
+            # Both opening and closing fence markers are stripped, along with the prose before a code block.
+            if self.in_code_block:
+                self.stopped = True
+            self.in_code_block = True
+            self.held = []
+            return ''
+
+        if self.stop_at_code_block_end and not self.in_code_block:
+            self.held.append(line)
+            return ''
+        return self.emit_line(line)
+
+    def emit_line(self, line: str) -> str:
+        for pattern in self.stop_patterns:
+            match = pattern.search(line)
+            if match:
+                self.stopped = True
+                return line[:match.start()]
+
+        if self.max_lines:
+            self.emitted_lines += 1
+            if self.emitted_lines > self.max_lines:
+                self.stopped = True
+                return ''
+        return line
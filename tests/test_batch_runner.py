@@ -0,0 +1,81 @@
+import os
+import shutil
+import sys
+from threading import Event
+from unittest import TestCase
+
+
+batch_module = sys.modules['OpenAI completion.batch_runner']
+assistant_module = sys.modules['OpenAI completion.assistant_settings']
+cacher_module = sys.modules['OpenAI completion.cacher']
+
+
+class TestBatchRunner(TestCase):
+    __text__ = "a = 1\nb = 2\nc = 3\nd = 4\n"
+
+    def runner(self, prompt_mode: str, **overrides):
+        assistant = assistant_module.AssistantSettings(**{
+            **assistant_module.DEFAULT_ASSISTANT_SETTINGS,
+            'name': 'test_string',
+            'prompt_mode': prompt_mode,
+            'chat_model': 'test_string',
+            'assistant_role': 'test_string',
+            **overrides
+        })
+        runner = batch_module.BatchRunner(
+            window=None,
+            stop_event=Event(),
+            assistant=assistant,
+            files=[],
+            instruction=None,
+            output=batch_module.BatchOutput.diff
+        )
+        # Only `get` is used, which a plain dict has as well.
+        runner.settings = {'batch_chunk_lines': 2}
+        return runner
+
+    def test_replace_keeps_chunk_line_breaks(self):
+        runner = self.runner(assistant_module.PromptMode.replace.value)
+        jobs = runner.create_jobs(file='test.py', text=self.__text__)
+
+        # Answers without a trailing line break, one of them wrapped into a code fence.
+        completions = ["A = 1\nB = 2", "```python\nC = 3\nD = 4\n```\n"]
+        result = ''.join(runner.apply_completion(job, completion) for job, completion in zip(jobs, completions))
+
+        self.assertEqual([job.text for job in jobs], ["a = 1\nb = 2\n", "c = 3\nd = 4\n"])
+        self.assertEqual(result, "A = 1\nB = 2\nC = 3\nD = 4\n")
+
+    def test_insert_and_passthrough(self):
+        runner = self.runner(assistant_module.PromptMode.insert.value, placeholder='[PLACEHOLDER]')
+        jobs = runner.create_jobs(file='test.py', text="a = [PLACEHOLDER]\nb = 2\nc = 3\nd = 4\n")
+
+        result = ''.join(runner.apply_completion(job, "```\n1\n```") for job in jobs)
+
+        self.assertTrue(jobs[1].passthrough)
+        self.assertEqual(result, "a = 1\nb = 2\nc = 3\nd = 4\n")
+
+
+class TestBatchJournal(TestCase):
+    __cacher__ = cacher_module.Cacher(name='test_')
+
+    def job(self, job_id: str):
+        return batch_module.BatchJob(job_id=job_id, file='test.py', chunk_index=0, text='test_string')
+
+    def test_survives_torn_record(self):
+        journal = batch_module.BatchJournal(cacher=self.__cacher__)
+        journal.record(job=self.job('test_job_1'), output='test_output')
+        # An interrupted run leaves a partially written line behind.
+        with open(self.__cacher__.batch_journal_file, 'a', encoding='utf-8') as file:
+            file.write('{"job": "test_job_2", "sta')
+
+        journal = batch_module.BatchJournal(cacher=self.__cacher__)
+        self.assertEqual(journal.done, {'test_job_1'})
+        self.assertEqual(journal.output('test_job_1'), 'test_output')
+
+        # The torn line is dropped, so the next record isn't glued to it.
+        journal.record(job=self.job('test_job_3'), output='test_output')
+        self.assertEqual(batch_module.BatchJournal(cacher=self.__cacher__).done, {'test_job_1', 'test_job_3'})
+
+    def tearDown(self):
+        shutil.rmtree(self.__cacher__.batch_outputs_dir, ignore_errors=True)
+        os.remove(self.__cacher__.batch_journal_file)
@@ -0,0 +1,119 @@
+import json
+import sys
+from unittest import TestCase
+
+
+cacher_module = sys.modules['OpenAI completion.cacher']
+
+
+class TestCacher(TestCase):
+    __cacher__ = cacher_module.Cacher(name='test_archive_')
+    __fake_history__ = [
+        {'role': 'user', 'content': 'some user instruction 1', 'name': 'OpenAI_completion'},
+        {'role': 'assistant', 'content': 'some assitant output 1'},
+        {'role': 'user', 'content': 'some user selection 2', 'name': 'OpenAI_completion'},
+        {'role': 'user', 'content': 'some user instruction 2', 'name': 'OpenAI_completion'},
+        {'role': 'assistant', 'content': 'some assitant output 2'},
+        {'role': 'user', 'content': 'some user instruction 3', 'name': 'OpenAI_completion'},
+        {'role': 'assistant', 'content': 'some assitant output 3'},
+    ]
+
+    def setUp(self):
+        self.__cacher__.append_to_cache(self.__fake_history__)
+
+    def test_archive_overflow_keeps_exchanges_whole(self):
+        self.__cacher__.archive_overflow(retention=4)
+
+        self.assertEqual(self.__cacher__.read_all(), self.__fake_history__[5:])
+        self.assertEqual(list(self.__cacher__.read_archive()), self.__fake_history__[:5])
+
+    def test_raw_history_is_utf8(self):
+        message = {'role': 'user', 'content': 'привет, 你好', 'name': 'OpenAI_completion'}
+        self.__cacher__.append_to_cache([message])
+
+        self.assertEqual(json.loads(self.__cacher__.read_all_raw()[-1].decode('utf-8')), message)
+
+    def test_legacy_history_is_converted_to_utf8(self):
+        message = {'role': 'user', 'content': 'café', 'name': 'OpenAI_completion'}
+        with open(self.__cacher__.history_file, 'ab') as file:
+            file.write(json.dumps(message, ensure_ascii=False).encode('cp1252') + b'\n')
+        cacher_module.Cacher.utf8_histories.discard(self.__cacher__.history_file)
+
+        getpreferredencoding = cacher_module.locale.getpreferredencoding
+        cacher_module.locale.getpreferredencoding = lambda do_setlocale=True: 'cp1252'
+        try:
+            raw_lines = self.__cacher__.read_all_raw()
+        finally:
+            cacher_module.locale.getpreferredencoding = getpreferredencoding
+
+        self.assertEqual(json.loads(raw_lines[-1].decode('utf-8')), message)
+        self.assertEqual(self.__cacher__.read_all(), self.__fake_history__ + [message])
+
+    def test_restore_segment(self):
+        self.__cacher__.archive_overflow(retention=2)
+        segments = self.__cacher__.archive_segments()
+
+        self.__cacher__.restore_segment(segments[0])
+
+        self.assertEqual(self.__cacher__.read_all(), self.__fake_history__)
+        self.assertEqual(self.__cacher__.archive_segments(), [])
+
+    def test_restored_history_is_not_archived_again(self):
+        self.__cacher__.archive_overflow(retention=2)
+        self.__cacher__.restore_segment(self.__cacher__.archive_segments()[0])
+
+        self.__cacher__.append_to_cache([{'role': 'user', 'content': 'some user instruction 4', 'name': 'OpenAI_completion'}])
+        self.__cacher__.archive_overflow(retention=2)
+        self.assertEqual(len(self.__cacher__.read_all()), len(self.__fake_history__) + 1)
+
+        # A reset brings archiving back.
+        self.__cacher__.drop_all()
+        self.__cacher__.append_to_cache(self.__fake_history__)
+        self.__cacher__.archive_overflow(retention=2)
+        self.assertEqual(self.__cacher__.read_all(), self.__fake_history__[5:])
+
+    def test_history_index_follows_archiving(self):
+        self.__cacher__.rebuild_history_index()
+        self.__cacher__.archive_overflow(retention=2)
+        self.__cacher__.append_to_cache([{'role': 'user', 'content': 'some user instruction 4', 'name': 'OpenAI_completion'}])
+
+        results = self.__cacher__.history_index.search('instruction')
+
+        self.assertEqual([seq for seq, _, _ in results], [7, 5, 3, 0])
+        self.assertEqual(self.__cacher__.history_index.locate(7), (None, 2))
+        self.assertEqual(self.__cacher__.history_index.locate(3), ('segment_000001.jl.gz', 3))
+
+    def test_content_digests_follow_history(self):
+        digest = cacher_module.content_digest('some user selection 2')
+        self.assertIn(digest, self.__cacher__.content_digests())
+
+        self.__cacher__.append_to_cache([{'role': 'user', 'content': 'some user selection 4', 'name': 'OpenAI_completion'}])
+        self.assertIn(cacher_module.content_digest('some user selection 4'), self.__cacher__.content_digests())
+
+        self.__cacher__.archive_overflow(retention=2)
+        self.assertNotIn(digest, self.__cacher__.content_digests())
+
+    def test_reference_is_rehydrated_once_original_is_archived(self):
+        original = '```python\nprint(1)\n```'
+        reference = 'The selected python code is unchanged since I\'ve sent it earlier in this conversation.'
+        self.__cacher__.drop_all()
+        self.__cacher__.append_to_cache([
+            {'role': 'user', 'content': original, 'name': 'OpenAI_completion'},
+            {'role': 'assistant', 'content': 'some assitant output 1'},
+        ])
+        self.__cacher__.remember_reference(reference=reference, original=original)
+        for number in (2, 3):
+            self.__cacher__.append_to_cache([
+                {'role': 'user', 'content': reference, 'name': 'OpenAI_completion'},
+                {'role': 'assistant', 'content': f'some assitant output {number}'},
+            ])
+
+        self.__cacher__.archive_overflow(retention=4)
+
+        # The first remaining reference gets the code back, the next one still refers to it.
+        self.assertEqual([message['content'] for message in self.__cacher__.read_all() if message['role'] == 'user'], [original, reference])
+
+    def tearDown(self):
+        self.__cacher__.drop_all()
+        for segment in self.__cacher__.archive_segments():
+            cacher_module.os.remove(segment)
@@ -0,0 +1,83 @@
+import socket
+import sys
+from threading import Thread
+from unittest import TestCase
+
+from sublime import Settings
+
+network_client_module = sys.modules['OpenAI completion.openai_network_client']
+assistant_module = sys.modules['OpenAI completion.assistant_settings']
+providers_module = sys.modules['OpenAI completion.providers']
+
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\ndata: [DONE]\n\n'
+
+
+class DroppingServer(Thread):
+    """Drops the first connection as an idle one would be dropped by a proxy, and answers the next one."""
+
+    def __init__(self) -> None:
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(2)
+        self.url = f'http://127.0.0.1:{self.server.getsockname()[1]}'
+        self.connections = 0
+        super(DroppingServer, self).__init__(daemon=True)
+
+    def run(self):
+        self.server.settimeout(5)
+        dropped, _ = self.server.accept()
+        self.connections += 1
+        dropped.close()
+
+        connection, _ = self.server.accept()
+        self.connections += 1
+        connection.recv(65536)
+        connection.sendall(RESPONSE)
+        connection.close()
+        self.server.close()
+
+
+class TestConnectionPrewarmer(TestCase):
+    def create_assistant(self, url: str):
+        return assistant_module.AssistantSettings(**{
+            **assistant_module.DEFAULT_ASSISTANT_SETTINGS,
+            'name': 'test_string',
+            'prompt_mode': assistant_module.PromptMode.insert.value,
+            'chat_model': 'test_string',
+            'assistant_role': 'test_string',
+            'provider': 'local',
+            'url': url,
+        })
+
+    def test_take_ignores_other_endpoint(self):
+        backend = providers_module.LocalProvider(url='http://127.0.0.1:1', token=None)
+        network_client_module.ConnectionPrewarmer.key = backend.connection_key(None)
+        network_client_module.ConnectionPrewarmer.connection = backend.create_connection(proxy_settings=None)
+
+        self.assertIsNone(network_client_module.ConnectionPrewarmer.take(key='another key'))
+        # A mismatched take discards the prewarmed connection.
+        self.assertIsNone(network_client_module.ConnectionPrewarmer.connection)
+        self.assertIsNone(network_client_module.ConnectionPrewarmer.key)
+
+    def test_dropped_connection_is_reopened(self):
+        server = DroppingServer()
+        server.start()
+        settings = Settings(id=0)
+        assistant = self.create_assistant(server.url)
+        backend = providers_module.create_provider(settings=settings, assistant=assistant)
+        key = backend.connection_key(settings.get('proxy'))
+        network_client_module.ConnectionPrewarmer.key = key
+        network_client_module.ConnectionPrewarmer.connect(settings, backend, key, assistant)
+
+        client = network_client_module.NetworkClient(settings, assistant=assistant)
+        self.assertTrue(client.prewarmed)
+        payload = client.prepare_payload(assitant_setting=assistant, messages=[{'role': 'user', 'content': 'test_string'}], with_history=False)
+        client.prepare_request(json_payload=payload)
+        response = client.execute_response()
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(server.connections, 2)
+        client.close_connection()
+
+    def tearDown(self):
+        network_client_module.ConnectionPrewarmer.discard()
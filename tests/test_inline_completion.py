@@ -0,0 +1,77 @@
+import socket
+import sys
+import time
+from threading import Event
+from unittest import TestCase
+
+inline_module = sys.modules['OpenAI completion.inline_completion']
+assistant_module = sys.modules['OpenAI completion.assistant_settings']
+
+
+class TestInlineCompletion(TestCase):
+    def test_strip_code_fence(self):
+        self.assertEqual(inline_module.strip_code_fence('```python\nprint(1)\n```'), 'print(1)')
+        self.assertEqual(inline_module.strip_code_fence('print(1)'), 'print(1)')
+
+    def test_cancel_interrupts_blocked_read(self):
+        # A server that accepts a request and never answers it.
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        assistant = assistant_module.AssistantSettings(**{
+            **assistant_module.DEFAULT_ASSISTANT_SETTINGS,
+            'name': 'test_string',
+            'prompt_mode': assistant_module.PromptMode.inline.value,
+            'chat_model': 'test_string',
+            'assistant_role': 'test_string',
+            'provider': 'local',
+            'url': f'http://127.0.0.1:{server.getsockname()[1]}',
+        })
+        done = Event()
+        request = inline_module.InlineCompletionRequest(assistant=assistant, prefix='a = ', suffix='', deadline=time.time() + 30, on_done=lambda _: done.set())
+        request.start()
+
+        connection, _ = server.accept()
+        self.addCleanup(connection.close)
+        connection.recv(65536)
+        # Waiting for the request to block on reading a response.
+        while request.provider is None or request.provider.sock is None:
+            time.sleep(0.01)
+
+        started_at = time.time()
+        request.cancel()
+        request.join(timeout=5)
+
+        self.assertLess(time.time() - started_at, 1)
+        self.assertFalse(request.is_alive())
+        self.assertFalse(done.is_set())
+
+    def test_cancel_before_connecting(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        server.settimeout(0.2)
+        self.addCleanup(server.close)
+
+        assistant = assistant_module.AssistantSettings(**{
+            **assistant_module.DEFAULT_ASSISTANT_SETTINGS,
+            'name': 'test_string',
+            'prompt_mode': assistant_module.PromptMode.inline.value,
+            'chat_model': 'test_string',
+            'assistant_role': 'test_string',
+            'provider': 'local',
+            'url': f'http://127.0.0.1:{server.getsockname()[1]}',
+        })
+        done = Event()
+        request = inline_module.InlineCompletionRequest(assistant=assistant, prefix='a = ', suffix='', deadline=time.time() + 30, on_done=lambda _: done.set())
+        # Cancelled while there's no socket to shut down yet.
+        request.cancel()
+        request.start()
+        request.join(timeout=5)
+
+        self.assertFalse(request.is_alive())
+        self.assertFalse(done.is_set())
+        with self.assertRaises(socket.timeout):
+            server.accept()
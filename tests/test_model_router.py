@@ -0,0 +1,45 @@
+import sys
+from unittest import TestCase
+
+
+router_module = sys.modules['OpenAI completion.model_router']
+assistant_module = sys.modules['OpenAI completion.assistant_settings']
+
+
+class TestModelRouter(TestCase):
+    __assistant_dict__ = {
+        'name': 'test_string',
+        'prompt_mode': 'panel',
+        'chat_model': 'test_default',
+        'assistant_role': 'test_string',
+        'max_tokens': 1000,
+        'models': [
+            {'name': 'test_slow_large', 'context_window': 128000, 'latency': 'slow'},
+            {'name': 'test_fast_small', 'context_window': 4000, 'latency': 'fast'},
+            {'name': 'test_fast_medium', 'context_window': 16000, 'latency': 'fast'},
+        ]
+    }
+
+    def assistant(self, **overrides):
+        return assistant_module.AssistantSettings(**{**assistant_module.DEFAULT_ASSISTANT_SETTINGS, **self.__assistant_dict__, **overrides})
+
+    def test_picks_fastest_fitting_model(self):
+        self.assertEqual(router_module.route_model(self.assistant(), prompt_tokens=2000).model, 'test_fast_small')
+        self.assertEqual(router_module.route_model(self.assistant(), prompt_tokens=10000).model, 'test_fast_medium')
+        self.assertEqual(router_module.route_model(self.assistant(), prompt_tokens=50000).model, 'test_slow_large')
+
+    def test_overflow_picks_largest_window(self):
+        decision = router_module.route_model(self.assistant(), prompt_tokens=200000)
+
+        self.assertEqual(decision.model, 'test_slow_large')
+        self.assertTrue(decision.overflow)
+
+    def test_unknown_latency_is_medium(self):
+        models = [
+            {'name': 'test_slow', 'context_window': 16000, 'latency': 'slow'},
+            {'name': 'test_typo', 'context_window': 16000, 'latency': 'fsat'},
+        ]
+        self.assertEqual(router_module.route_model(self.assistant(models=models), prompt_tokens=2000).model, 'test_typo')
+
+    def test_no_candidates_fall_back_to_chat_model(self):
+        self.assertEqual(router_module.route_model(self.assistant(models=None), prompt_tokens=2000).model, 'test_default')
@@ -1,13 +1,19 @@
 from json import dumps, loads
 from typing import Optional, Any
 from sublime import Settings
+from threading import Thread
+import os
+import socket
 import sys
+import tempfile
 from unittest import TestCase
 
 
 network_client_module = sys.modules['OpenAI completion.openai_network_client']
 assistant_module = sys.modules['OpenAI completion.assistant_settings']
 cacher_module = sys.modules['OpenAI completion.cacher']
+providers_module = sys.modules['OpenAI completion.providers']
+errors_module = sys.modules['OpenAI completion.errors.OpenAIException']
 
 
 class TestNetworkClient(TestCase):
@@ -57,7 +63,7 @@ class TestNetworkClient(TestCase):
         messages_to_test.insert(0, self.__system_instruction__)
 
         payload = self.__network_instance__.prepare_payload(assitant_setting=assistant_settings, messages=messages_to_pass)
-        payload_json = loads(payload)
+        payload_json = loads(bytes(payload))
 
         self.assertEqual(
             dumps(payload_json['messages']),
@@ -81,7 +87,7 @@ class TestNetworkClient(TestCase):
         messages_to_test.insert(0, self.__system_instruction__)
 
         payload = self.__network_instance__.prepare_payload(assitant_setting=assistant_settings, messages=messages_to_pass)
-        payload_json = loads(payload)
+        payload_json = loads(bytes(payload))
 
         self.assertEqual(
             dumps(payload_json['messages']),
@@ -89,6 +95,91 @@ class TestNetworkClient(TestCase):
             f'\npayload: {dumps(payload_json["messages"])}\nmessage: {dumps(messages_to_test)}'
         )
 
+    def test_usage_is_requested_on_demand(self):
+        assistant_settings = assistant_module.AssistantSettings(
+            **{
+                **assistant_module.DEFAULT_ASSISTANT_SETTINGS,
+                **self.__assistant_dict__,
+                'prompt_mode': assistant_module.PromptMode.insert.value
+            }
+        )
+
+        payload = self.__network_instance__.prepare_payload(assitant_setting=assistant_settings, messages=self.__messages_to_append__)
+        self.assertNotIn('stream_options', loads(bytes(payload)))
+
+        payload = self.__network_instance__.prepare_payload(assitant_setting=assistant_settings, messages=self.__messages_to_append__, include_usage=True)
+        self.assertEqual(loads(bytes(payload))['stream_options'], {'include_usage': True})
+
+        lines = [
+            b'data: {"choices": [{"delta": {"content": "test_string"}}]}',
+            b'data: {"choices": [], "usage": {"completion_tokens": 3}}',
+            b'data: [DONE]',
+        ]
+        self.assertEqual(list(network_client_module.sse_deltas(lines)), [{'content': 'test_string'}])
+        self.assertEqual(list(network_client_module.sse_chunks(lines))[-1]['usage'], {'completion_tokens': 3})
+
     def tearDown(self):
         self.__network_instance__ = None
         self.__cacher__.drop_all()
+
+
+class TestProviders(TestCase):
+    __assistant_dict__ = {
+        'name': 'test_string',
+        'prompt_mode': 'panel',
+        'chat_model': 'test_string',
+        'assistant_role': 'test_string'
+    }
+
+    def assistant(self, **overrides):
+        return assistant_module.AssistantSettings(**{**assistant_module.DEFAULT_ASSISTANT_SETTINGS, **self.__assistant_dict__, **overrides})
+
+    def test_openai_map_error(self):
+        provider = providers_module.OpenAIProvider(url='https://test', token=None)
+
+        context_error = provider.map_error(status=400, body=dumps({'error': {'code': 'context_length_exceeded', 'message': 'test_string'}}))
+        self.assertIsInstance(context_error, errors_module.ContextLengthExceededException)
+        self.assertEqual(context_error.message, 'test_string')
+        self.assertIsInstance(provider.map_error(status=500, body='not a json'), errors_module.UnknownException)
+
+    def test_local_map_error(self):
+        provider = providers_module.LocalProvider(url='http://test', token=None)
+
+        # llama.cpp
+        llama_error = provider.map_error(status=400, body=dumps({'error': {'type': 'exceed_context_size_error', 'message': 'test_string'}}))
+        self.assertIsInstance(llama_error, errors_module.ContextLengthExceededException)
+        # Ollama
+        ollama_error = provider.map_error(status=400, body=dumps({'error': 'input exceeds the context length'}))
+        self.assertIsInstance(ollama_error, errors_module.ContextLengthExceededException)
+        self.assertIsInstance(provider.map_error(status=500, body=dumps({'error': 'model not found'})), errors_module.UnknownException)
+
+    def test_own_endpoint_does_not_inherit_token(self):
+        # Only `get` is used, which a plain dict has as well.
+        settings = {'url': 'https://test', 'token': 'test_global_token'}
+
+        local = providers_module.create_provider(settings=settings, assistant=self.assistant(provider='local', url='http://localhost:11434'))
+        self.assertIsNone(local.token)
+        self.assertNotIn('Authorization', local.headers())
+        same_endpoint = providers_module.create_provider(settings=settings, assistant=self.assistant(url='https://test'))
+        self.assertEqual(same_endpoint.token, 'test_global_token')
+
+    def test_unix_socket_connection(self):
+        socket_path = os.path.join(tempfile.mkdtemp(), 'test.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(1)
+
+        def serve():
+            connection, _ = server.accept()
+            connection.recv(65536)
+            connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok')
+            connection.close()
+        Thread(target=serve, daemon=True).start()
+
+        connection = providers_module.LocalProvider(url=f'unix://{socket_path}', token=None).create_connection(proxy_settings=None)
+        self.assertIsInstance(connection, providers_module.UnixSocketConnection)
+        connection.request('POST', '/v1/chat/completions', body=b'{}')
+        response = connection.getresponse()
+        self.assertEqual(response.read(), b'ok')
+        connection.close()
+        server.close()
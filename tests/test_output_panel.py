@@ -1,12 +1,69 @@
-from unittest import TestCase
 import sys
-from typing import Optional, Any
+from unittest import TestCase
+
+
+output_panel_module = sys.modules['OpenAI completion.output_panel']
+
+
+class LineRegion():
+    def __init__(self, begin: int, end: int) -> None:
+        self.a, self.b = begin, end
+
+    def end(self) -> int:
+        return self.b
+
+
+class FakeView():
+    """Just enough of a view for trimming, the `erase_region` and `text_stream_at` commands are applied to a string."""
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+    def size(self) -> int:
+        return len(self.text)
+
+    def line(self, point: int) -> LineRegion:
+        begin = self.text.rfind('\n', 0, point) + 1
+        end = self.text.find('\n', point)
+        return LineRegion(begin, end if end != -1 else len(self.text))
+
+    def run_command(self, command: str, args: dict):
+        if command == 'erase_region':
+            self.text = self.text[:args['region']['a']] + self.text[args['region']['b']:]
+        elif command == 'text_stream_at':
+            self.text = self.text[:args['position']] + args['text'] + self.text[args['position']:]
 
 
 class TestOutputPanel(TestCase):
+    def listener(self, max_chars: int):
+        listener = output_panel_module.SharedOutputPanelListener(markdown=False)
+        # Only `get` is used, which a plain dict has as well.
+        listener.settings = {'output_panel_max_chars': max_chars}
+        return listener
+
+    def test_trim_keeps_whole_recent_lines(self):
+        lines = [f'line {index:02}'.ljust(19) + '\n' for index in range(10)]
+        view = FakeView(''.join(lines))
+
+        self.listener(max_chars=100).trim_output_view_(view)
+
+        self.assertTrue(view.text.startswith(output_panel_module.TRIMMED_CONTENT_MARKER))
+        kept = view.text[len(output_panel_module.TRIMMED_CONTENT_MARKER):]
+        self.assertEqual(kept, ''.join(lines[-len(kept) // 20:]))
+        self.assertLessEqual(len(kept), 80)
+
+    def test_trim_leaves_small_view_untouched(self):
+        view = FakeView('short\n')
+
+        self.listener(max_chars=100).trim_output_view_(view)
+        self.listener(max_chars=0).trim_output_view_(view)
+
+        self.assertEqual(view.text, 'short\n')
 
-    def setUp(self):
-        pass
+    def test_first_rendered_message(self):
+        messages = [{'role': 'user', 'content': 'x' * 30}, {'role': 'assistant', 'content': 'y' * 30}, {'role': 'user', 'content': 'z' * 200}]
 
-    def tearDown(self):
-        pass
+        self.assertEqual(self.listener(max_chars=0).first_rendered_message_(messages), 0)
+        self.assertEqual(self.listener(max_chars=100).first_rendered_message_(messages[:2]), 0)
+        # The most recent message is always rendered, even if it exceeds the limit on its own.
+        self.assertEqual(self.listener(max_chars=100).first_rendered_message_(messages), 2)
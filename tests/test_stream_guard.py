@@ -0,0 +1,56 @@
+import sys
+from unittest import TestCase
+
+
+stream_guard_module = sys.modules['OpenAI completion.stream_guard']
+
+
+class TestStreamStopDetector(TestCase):
+    def stream(self, detector, chunks):
+        output = ''.join(detector.feed(chunk) for chunk in chunks)
+        return output + detector.flush()
+
+    def test_stops_at_code_block_end_and_strips_fences(self):
+        detector = stream_guard_module.StreamStopDetector(stop_at_code_block_end=True)
+
+        output = self.stream(detector, ['```py', 'thon\nprint(1)\n', 'print(2)\n``', '`\nThis code prints', ' numbers.\n'])
+
+        self.assertEqual(output, 'print(1)\nprint(2)\n')
+        self.assertTrue(detector.stopped)
+
+    def test_drops_prose_before_code_block(self):
+        detector = stream_guard_module.StreamStopDetector(stop_at_code_block_end=True)
+
+        output = self.stream(detector, ['Here is the fixed code:\n\n', '```python\nprint(1)\n```\n'])
+
+        self.assertEqual(output, 'print(1)\n')
+
+    def test_passes_through_answer_without_code_block(self):
+        detector = stream_guard_module.StreamStopDetector(stop_at_code_block_end=True, max_lines=2)
+
+        output = self.stream(detector, ['a = 1\n', 'b = 2\n', 'c = 3'])
+
+        self.assertEqual(output, 'a = 1\nb = 2\n')
+        self.assertTrue(detector.stopped)
+
+    def test_stops_at_pattern(self):
+        detector = stream_guard_module.StreamStopDetector(stop_patterns=[r'Explanation:'])
+
+        output = self.stream(detector, ['a = 1\n', 'Explanation: ', 'it assigns\n'])
+
+        self.assertEqual(output, 'a = 1\n')
+        self.assertTrue(detector.stopped)
+
+    def test_stops_after_max_lines(self):
+        detector = stream_guard_module.StreamStopDetector(max_lines=2)
+
+        output = self.stream(detector, ['1\n2\n3\n4'])
+
+        self.assertEqual(output, '1\n2\n')
+        self.assertTrue(detector.stopped)
+
+    def test_passes_through_unfinished_last_line(self):
+        detector = stream_guard_module.StreamStopDetector(stop_at_code_block_end=True)
+
+        self.assertEqual(self.stream(detector, ['a = ', '1']), 'a = 1')
+        self.assertFalse(detector.stopped)
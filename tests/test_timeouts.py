@@ -0,0 +1,83 @@
+import socket
+import sys
+from threading import Event, Thread
+from unittest import TestCase
+
+from sublime import Settings
+
+network_client_module = sys.modules['OpenAI completion.openai_network_client']
+assistant_module = sys.modules['OpenAI completion.assistant_settings']
+errors_module = sys.modules['OpenAI completion.errors.OpenAIException']
+
+
+class StallingServer(Thread):
+    """Accepts a single connection, sends `response` and then stays silent until it's released."""
+
+    def __init__(self, response: bytes = b'') -> None:
+        self.response = response
+        self.released = Event()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.url = f'http://127.0.0.1:{self.server.getsockname()[1]}'
+        super(StallingServer, self).__init__(daemon=True)
+
+    def run(self):
+        connection, _ = self.server.accept()
+        connection.recv(65536)
+        if self.response:
+            connection.sendall(self.response)
+        self.released.wait(5)
+        connection.close()
+        self.server.close()
+
+
+class TestTimeouts(TestCase):
+    def create_client(self, url: str, timeouts):
+        assistant = assistant_module.AssistantSettings(**{
+            **assistant_module.DEFAULT_ASSISTANT_SETTINGS,
+            'name': 'test_string',
+            'prompt_mode': assistant_module.PromptMode.insert.value,
+            'chat_model': 'test_string',
+            'assistant_role': 'test_string',
+            'provider': 'local',
+            'url': url,
+            'timeouts': timeouts,
+        })
+        client = network_client_module.NetworkClient(Settings(id=0), assistant=assistant)
+        payload = client.prepare_payload(assitant_setting=assistant, messages=[{'role': 'user', 'content': 'test_string'}], with_history=False)
+        return client, payload
+
+    def start_server(self, response: bytes = b'') -> StallingServer:
+        server = StallingServer(response=response)
+        server.start()
+        self.addCleanup(server.released.set)
+        return server
+
+    def test_first_byte_timeout(self):
+        server = self.start_server()
+        client, payload = self.create_client(server.url, {'first_byte': 0.2})
+        client.prepare_request(json_payload=payload)
+
+        with self.assertRaises(errors_module.FirstByteTimeoutException):
+            client.execute_response()
+
+    def test_idle_timeout(self):
+        server = self.start_server(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n\r\ndata: {"choices": []}\n\n')
+        client, payload = self.create_client(server.url, {'idle': 0.2})
+        client.prepare_request(json_payload=payload)
+        response = client.execute_response()
+
+        lines = client.iterate_response(response)
+        self.assertEqual(next(lines), b'data: {"choices": []}\n')
+        with self.assertRaises(errors_module.IdleTimeoutException):
+            list(lines)
+
+    def test_total_deadline_bounds_idle_timeout(self):
+        server = self.start_server(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n\r\n')
+        client, payload = self.create_client(server.url, {'idle': 30, 'total': 0.3})
+        client.prepare_request(json_payload=payload)
+        response = client.execute_response()
+
+        with self.assertRaises(errors_module.DeadlineExceededException):
+            list(client.iterate_response(response))
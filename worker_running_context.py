@@ -1,9 +1,11 @@
 from .openai import Openai
 from .openai_panel import OpenaiPanelCommand
+from .batch_runner import OpenaiBatchCommand
+from .compare_assistants import OpenaiCompareAssistantsCommand
 from sublime_plugin import EventListener
 
 class OpenaiWorkerRunningContext(EventListener):
     def on_query_context(self, view, key, operator, operand, match_all):
         if key == "openai_worker_running":
-            return Openai.worker_thread is not None and Openai.worker_thread.is_alive() or OpenaiPanelCommand.worker_thread is not None and OpenaiPanelCommand.worker_thread.is_alive()
+            return Openai.worker_thread is not None and Openai.worker_thread.is_alive() or OpenaiPanelCommand.worker_thread is not None and OpenaiPanelCommand.worker_thread.is_alive() or OpenaiBatchCommand.runner is not None and OpenaiBatchCommand.runner.is_alive() or OpenaiCompareAssistantsCommand.is_running()
         return None